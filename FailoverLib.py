@@ -1,15 +1,36 @@
 #! /usr/bin/env python
 
+import BaseHTTPServer
+import calendar
+import collections
+import contextlib
+import cPickle
+import glob
+import gzip
+import hashlib
+import httplib
 import itertools
+import json
+import mmap
+import multiprocessing
 import os
+import Queue
 import re
+import resource
+import smtplib
 import socket
+import SocketServer
 import sys
+import threading
+import time
 import urllib2
+import urlparse
 
+import numpy as np
 import pandas as pd
 import pygeoip
 
+from cStringIO import StringIO
 from datetime import datetime
 from functools import partial
 from unidecode import unidecode
@@ -25,18 +46,73 @@ def load_awstats_data (machine, base_path, date=None):
     aws_file = os.path.expanduser(aws_file_tpl.format(base=base_path,
                                                       date=date_string,
                                                       instance=machine))
-    data = get_awstats_hosts_info(aws_file)
+    return read_awstats_visitors(aws_file)
 
-    if len(data):
-        dataframe = pd.DataFrame(data)
-        del dataframe['Pages']               # Because it is identical to 'Hits'
-        del dataframe['Last visit']        # Most of the time is not useful info
+def read_awstats_visitors (awstats_file):
 
-    else:
-        dataframe = pd.DataFrame(None,
-                                 columns=('Host', 'Hits', 'Bandwidth'))
+    columns = ['Host', 'Hits', 'Bandwidth']
+    empty = pd.DataFrame(None, columns=columns)
+
+    try:
+        awsf = open(awstats_file, 'rb')
+    except IOError:
+        sys.stderr.write("I/O Exception when trying to open file {0}.\n".format(awstats_file))
+        return empty
+
+    try:
+        aws_map = mmap.mmap(awsf.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, mmap.error):
+        sys.stderr.write("The file {0} is malformed.\n".format(awstats_file))
+        awsf.close()
+        return empty
+    awsf.close()
+
+    try:
+        block = get_awstats_visitor_block(aws_map)
+    finally:
+        aws_map.close()
+
+    if block is None:
+        sys.stderr.write("The file {0} is malformed.\n".format(awstats_file))
+        return empty
+    if not block:
+        return empty
+
+    #Host - Pages - Hits - Bandwidth - Last visit date - [Start date of last visit] - [Last page of last visit]
+    # The C parser builds the typed columns directly, skipping the rest. Lines
+    # have 5 or 7 fields, so the columns must be selected by position.
+    visitors = pd.read_csv(StringIO(block), sep=' ', header=None,
+                           names=columns, usecols=[0, 2, 3],
+                           dtype={'Hits': np.int64, 'Bandwidth': np.int64},
+                           na_filter=False, engine='c')
+
+    return visitors.reindex(columns=columns)
+
+def get_awstats_visitor_block (aws_map):
+
+    # Byte offset of the section, as listed in the MAP header
+    pos_line = aws_map.find('\nPOS_VISITOR ')
+    if pos_line < 0:
+        return None
+    pos_end = aws_map.find('\n', pos_line + 1)
+    try:
+        start_read = int(aws_map[pos_line+1:pos_end].split()[1])
+    except (IndexError, ValueError):
+        return None
+
+    if not aws_map[start_read:start_read+13] == 'BEGIN_VISITOR':
+        # Stale offset: look the section up by name instead
+        start_read = aws_map.find('\nBEGIN_VISITOR ') + 1
+        if start_read == 0:
+            return None
 
-    return dataframe
+    # Skip the BEGIN_VISITOR line, then take everything up to END_VISITOR
+    begin = aws_map.find('\n', start_read) + 1
+    end = aws_map.find('\nEND_VISITOR', begin - 1)
+    if begin == 0 or end < 0:
+        return None
+
+    return aws_map[begin:end+1]
 
 def get_awstats_hosts_info (awstats_file, parse_timestamps=False):
 
@@ -83,20 +159,239 @@ def get_awstats_hosts_info (awstats_file, parse_timestamps=False):
 
     return aws_list
 
-def download_aggregated_awstats_data (machines, base_path, date=None):
+def download_aggregated_awstats_data (machines, base_path, date=None, resolver=None,
+                                      workers=0):
 
-    ag = [ load_awstats_data(machine, base_path, date) for machine in machines ]
+    aggregated = load_aggregated_awstats_data(machines, base_path, date, workers)
 
-    aggregated = pd.concat(ag).groupby('Host').agg({'Hits': sum,
-                                                    'Bandwidth': sum})
-    aggregated.reset_index(inplace=True)
+    if resolver is None:
+        resolver = HostResolver()
+    aggregated['Ip'] = resolver.get_hosts_ipv4_addr(aggregated['Host'])
+
+    return compact_host_table(aggregated)
+
+def load_aggregated_awstats_data (machines, base_path, date=None, workers=0, pool=None):
+
+    tasks = [ (machine, base_path, date) for machine in machines ]
+
+    return merge_awstats_host_sums(map_awstats_host_sums(tasks, workers, pool))
+
+def load_archived_awstats_data (machines, snapshots, workers=0, pool=None):
+
+    # Snapshots are (base_path, date) pairs; all of their instances are
+    # parsed in a single pool, then merged snapshot by snapshot.
+    tasks = [ (machine, base_path, date) for base_path, date in snapshots
+                                         for machine in machines ]
+    partials = map_awstats_host_sums(tasks, workers, pool)
+
+    count = len(machines)
+    return [ merge_awstats_host_sums(partials[i:i + count])
+             for i in range(0, len(partials), count) ]
 
-    aggregated['Ip'] = aggregated['Host'].apply(get_host_ipv4_addr)
+def map_awstats_host_sums (tasks, workers=0, pool=None):
+
+    # A pool made beforehand (e.g. before any thread was started) can be
+    # shared, and from several threads; otherwise one is made for the call.
+    # Either way a call has at most as many tasks running as its workers.
+    if pool is not None and workers > 1 and len(tasks) > 1:
+        return flatten( pool.map(load_awstats_host_sums, tasks[i:i + workers])
+                        for i in range(0, len(tasks), workers) )
+
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        try:
+            return pool.map(load_awstats_host_sums, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    return [ load_awstats_host_sums(task) for task in tasks ]
+
+def merge_awstats_host_sums (partials):
+
+    # Each instance is already reduced by host, so only the partials get merged
+    aggregated = pd.concat(partials).groupby(level=0).sum()
+    aggregated.index.name = 'Host'
+    aggregated.reset_index(inplace=True)
     aggregated['Hits'] = aggregated['Hits'].astype(int)
     aggregated['Bandwidth'] = aggregated['Bandwidth'].astype(int)
 
     return aggregated
 
+def load_awstats_host_sums (task):
+
+    machine, base_path, date = task
+    data = load_awstats_data(machine, base_path, date)
+
+    return data.groupby('Host')[['Hits', 'Bandwidth']].sum()
+
+class LogTailer(object):
+
+    def __init__ (self, file_path, from_end=True):
+
+        self.file_path = os.path.expanduser(file_path)
+        self.inode = None
+        self.offset = 0
+        self.partial = ''
+
+        if from_end and os.path.exists(self.file_path):
+            stat = os.stat(self.file_path)
+            self.inode, self.offset = stat.st_ino, stat.st_size
+
+    def read_lines (self):
+
+        try:
+            stat = os.stat(self.file_path)
+        except OSError:
+            return []
+
+        # Start over when the log has been rotated or truncated
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.inode, self.offset, self.partial = stat.st_ino, 0, ''
+
+        if stat.st_size == self.offset:
+            return []
+
+        with open(self.file_path, 'rb') as fobj:
+            fobj.seek(self.offset)
+            chunk = fobj.read(stat.st_size - self.offset)
+        self.offset += len(chunk)
+
+        lines = (self.partial + chunk).split('\n')
+        self.partial = lines.pop()
+
+        return lines
+
+class SlidingWindowCounter(object):
+
+    # Per-client Hits/Bandwidth over the last `window` seconds, kept in a ring
+    # of fixed-size time buckets so that memory does not grow with time.
+
+    def __init__ (self, window=3600, bucket=60):
+
+        self.bucket = bucket
+        self.size = max(1, int(window // bucket))
+        self.slots = [ None ] * self.size
+        self.counts = [ {} for i in range(self.size) ]
+        self.first_seen = None
+        self.lock = threading.Lock()
+
+    def add (self, timestamp, client, hits, nbytes):
+
+        slot_id = int(timestamp // self.bucket)
+        index = slot_id % self.size
+
+        with self.lock:
+            if self.slots[index] != slot_id:
+                if self.slots[index] is not None and self.slots[index] > slot_id:
+                    return                     # Older than the whole window
+                self.slots[index] = slot_id
+                self.counts[index] = {}
+            if self.first_seen is None or timestamp < self.first_seen:
+                self.first_seen = timestamp
+
+            counts = self.counts[index].setdefault(client, [0, 0])
+            counts[0] += hits
+            counts[1] += nbytes
+
+    def totals (self, now):
+
+        oldest_slot = int(now // self.bucket) - self.size + 1
+        totals = collections.defaultdict(lambda: [0, 0])
+
+        with self.lock:
+            for slot_id, counts in zip(self.slots, self.counts):
+                if slot_id is None or slot_id < oldest_slot:
+                    continue
+                for client, (hits, nbytes) in counts.items():
+                    total = totals[client]
+                    total[0] += hits
+                    total[1] += nbytes
+            first_seen = self.first_seen
+
+        span = self.size * self.bucket
+        if first_seen is not None:
+            span = min(span, max(now - first_seen, self.bucket))
+
+        return totals, span
+
+class AccessLogStream(object):
+
+    squid_pattern = re.compile(r'^(\d+\.\d+)\s+\d+\s+(\S+)\s+\S+\s+(\d+)\s')
+    combined_pattern = re.compile(r'^(\S+) \S+ \S+ \[([^\]]+)\] "[^"]*" \d+ (\d+|-)')
+
+    def __init__ (self, log_files, log_format='squid', window=3600, bucket=60,
+                  from_end=True):
+
+        if log_format not in ('squid', 'combined'):
+            raise ValueError("Unknown access log format: {0}".format(log_format))
+
+        self.tailers = [ LogTailer(log_file, from_end) for log_file in log_files ]
+        self.parse_line = getattr(self, '_parse_' + log_format)
+        self.counter = SlidingWindowCounter(window, bucket)
+        self._last_time_str = None
+
+    def poll (self):
+
+        parsed = 0
+        for tailer in self.tailers:
+            for line in tailer.read_lines():
+                entry = self.parse_line(line)
+                if entry is not None:
+                    self.counter.add(*entry)
+                    parsed += 1
+
+        return parsed
+
+    def rates (self, resolver, now=None):
+
+        if now is None:
+            now = time.time()
+
+        totals, span = self.counter.totals(now)
+        columns = ['Host', 'Hits', 'Bandwidth']
+        table = pd.DataFrame([ (client, hits, nbytes) for client, (hits, nbytes) in totals.items() ],
+                             columns=columns)
+
+        # Same layout as the output of compute_traffic_delta
+        table['Ip'] = resolver.get_hosts_ipv4_addr(table['Host'])
+        table = table[ (table['Hits'] > 0) & (table['Bandwidth'] > 0) ].copy()
+        table['HitsRate'] = table['Hits'] / float(span)
+        table['BandwidthRate'] = table['Bandwidth'] / float(span)
+
+        table = table.reindex(columns=['Ip', 'Host', 'Hits', 'Bandwidth',
+                                       'HitsRate', 'BandwidthRate'])
+
+        return compact_host_table(table)
+
+    def _parse_squid (self, line):
+
+        # Squid native format: time elapsed client code/status bytes method URL ...
+        match = self.squid_pattern.match(line)
+        if not match:
+            return None
+
+        timestamp, client, nbytes = match.groups()
+        return float(timestamp), client, 1, int(nbytes)
+
+    def _parse_combined (self, line):
+
+        # Apache-like format, as written by frontier-squid
+        match = self.combined_pattern.match(line)
+        if not match:
+            return None
+
+        client, time_str, nbytes = match.groups()
+        if time_str != self._last_time_str:
+            date_part, _, zone = time_str.partition(' ')
+            epoch = calendar.timegm(time.strptime(date_part, '%d/%b/%Y:%H:%M:%S'))
+            if zone:
+                offset = 3600 * int(zone[1:3]) + 60 * int(zone[3:5])
+                epoch -= offset if zone[0] == '+' else -offset
+            self._last_time_str, self._last_time = time_str, epoch
+
+        return self._last_time, client, 1, 0 if nbytes == '-' else int(nbytes)
+
 def get_url (url):
 
     rq = urllib2.Request (url)
@@ -104,7 +399,148 @@ def get_url (url):
 
     return data
 
-def parse_geolist (geolist_raw):
+class CachedFetcher(object):
+
+    def __init__ (self, directory='cache', timeout=60):
+
+        self.directory = os.path.expanduser(directory)
+        self.timeout = timeout
+        self.stats = collections.Counter()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def get_url (self, url):
+
+        url_key = hashlib.sha1(url).hexdigest()
+        body_file = os.path.join(self.directory, 'url-{0}.body'.format(url_key))
+        meta_file = os.path.join(self.directory, 'url-{0}.json'.format(url_key))
+
+        cached_body = None
+        meta = {}
+        if os.path.exists(body_file) and os.path.exists(meta_file):
+            cached_body = open(body_file, 'rb').read()
+            meta = json.load(open(meta_file))
+
+        rq = urllib2.Request(url)
+        if cached_body is not None:
+            if meta.get('etag'):
+                rq.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                rq.add_header('If-Modified-Since', meta['last_modified'])
+
+        try:
+            response = urllib2.urlopen(rq, timeout=self.timeout)
+            data = response.read()
+
+        except urllib2.HTTPError as e:
+            if cached_body is None:
+                raise
+            if e.code != 304:
+                self._warn_stale(url, e)
+                self.stats['stale'] += 1
+            else:
+                self.stats['not_modified'] += 1
+            return cached_body
+
+        except (urllib2.URLError, httplib.HTTPException, socket.error) as e:
+            # Keep running from the last good copy when the server is unavailable
+            if cached_body is None:
+                raise
+            self._warn_stale(url, e)
+            self.stats['stale'] += 1
+            return cached_body
+
+        self.stats['downloaded'] += 1
+
+        headers = response.info()
+        meta = {'url': url,
+                'etag': headers.getheader('ETag'),
+                'last_modified': headers.getheader('Last-Modified')}
+        write_atomically(body_file, data)
+        write_atomically(meta_file, json.dumps(meta))
+
+        return data
+
+    def load_parsed (self, key):
+
+        parsed_file = os.path.join(self.directory, 'parsed-{0}.pickle'.format(key))
+        if not os.path.exists(parsed_file):
+            self.stats['parsed_misses'] += 1
+            return None
+
+        try:
+            parsed = cPickle.load(open(parsed_file, 'rb'))
+        except (cPickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            sys.stderr.write("The cache file {0} is corrupt (ignored).\n".format(parsed_file))
+            self.stats['parsed_misses'] += 1
+            return None
+
+        # Results that depend on more than the inputs (e.g. DNS answers) go
+        # stale; so do those saved without an expiry time by older versions
+        if not isinstance(parsed, dict) or parsed['expires'] <= time.time():
+            self.stats['parsed_expired'] += 1
+            return None
+
+        self.stats['parsed_hits'] += 1
+        return parsed['parsed']
+
+    def load_latest_parsed (self):
+
+        # Whatever was parsed last, for any inputs (e.g. to compare against)
+        parsed_files = glob.glob(os.path.join(self.directory, 'parsed-*.pickle'))
+        if not parsed_files:
+            return None
+
+        parsed_file = max(parsed_files, key=os.path.getmtime)
+        try:
+            parsed = cPickle.load(open(parsed_file, 'rb'))
+        except (cPickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None
+
+        return parsed['parsed'] if isinstance(parsed, dict) else parsed
+
+    def save_parsed (self, key, obj, expires=None):
+
+        parsed_file = os.path.join(self.directory, 'parsed-{0}.pickle'.format(key))
+        parsed = {'parsed': obj, 'expires': float('inf') if expires is None else expires}
+        write_atomically(parsed_file, cPickle.dumps(parsed, cPickle.HIGHEST_PROTOCOL))
+
+        # Only the results for the current inputs are worth keeping
+        for old_file in glob.glob(os.path.join(self.directory, 'parsed-*.pickle')):
+            if old_file != parsed_file:
+                os.remove(old_file)
+
+    def _warn_stale (self, url, error):
+
+        message = "Could not fetch {0} ({1}), using the last good copy.\n"
+        sys.stderr.write(message.format(url, error))
+
+def content_digest (*contents):
+
+    digest = hashlib.sha1()
+    for content in contents:
+        digest.update(hashlib.sha1(content).digest())
+
+    return digest.hexdigest()
+
+def file_digest (file_path, block_size=1<<20):
+
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as fobj:
+        for block in iter(lambda: fobj.read(block_size), ''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def write_atomically (file_path, data):
+
+    temp_file = file_path + '.tmp'
+    with open(temp_file, 'wb') as fobj:
+        fobj.write(data)
+    os.rename(temp_file, file_path)
+
+def parse_geolist (geolist_raw, resolver=None):
 
     geo_str_unicode = unicode(geolist_raw, pygeoip.ENCODING)
     geo_str_ascii = unidecode(geo_str_unicode)
@@ -123,39 +559,30 @@ def parse_geolist (geolist_raw):
         proxies = set( e[4].strip(';DIRECT').replace(';','|').split('|') )
 
         for proxy in proxies:
-            host_name = proxy.replace('/','')
-            squids.extend( gen_geo_entries(host_name, institution, site) )
+            squids.append({'Institution': institution,
+                           'Site': site,
+                           'Host': proxy.replace('/','')})
 
-    return pd.DataFrame(squids)
+    if resolver is None:
+        resolver = HostResolver()
 
-def gen_geo_entries (squid_hostname, institution, site):
+    # All proxies are looked up together rather than one after the other
+    return pd.DataFrame( gen_geo_entries_batch(pd.DataFrame(squids), resolver) )
 
-    host_data = squid_hostname.split(':')
-    if len(host_data) == 1:
-        listed_host_name = host_data[0]
-        protocol = port = ''
-    else:
-        protocol, listed_host_name, port = host_data
+def diff_geo_tables (old_geo, new_geo):
 
-    ip_addresses = simple_get_hosts_ipv4_addrs(listed_host_name)
-    is_dns = (len(ip_addresses) > 1)
+    # Squid entries (by site, alias, host name and address) that were added
+    # or removed from one geo table to the next
+    key = ['Site', 'Alias', 'Host', 'Ip']
+    old_keys = old_geo[key].drop_duplicates()
+    new_keys = new_geo[key].drop_duplicates()
 
-    entries = []
-    for ip in ip_addresses:
+    both = pd.concat([old_keys.assign(Change='-'), new_keys.assign(Change='+')],
+                     ignore_index=True)
+    changed = both.drop_duplicates(subset=key, keep=False)
 
-        if ip == '0.0.0.0':
-            host_name = listed_host_name
-        else:
-            host_name = socket.getfqdn(ip)
-
-        entries.append({'Institution': institution,
-                        'Site': site,
-                        'Host': host_name,
-                        'Alias': listed_host_name,
-                        'Ip': ip,
-                        'Port': port,
-                        'IsDNS': is_dns})
-    return entries
+    return changed.sort_values(key + ['Change'])\
+                  .reindex(columns=['Change'] + key).reset_index(drop=True)
 
 def parse_exceptionlist (exceptionlist_data):
 
@@ -198,40 +625,101 @@ def parse_exceptionlist (exceptionlist_data):
 
     return actions, workernode_view, monitoring_view
 
-def patch_geo_table (geo, MO_view, WN_view, actions, geoip):
+def gen_geo_entries_batch (squids, resolver):
+
+    records = squids.to_dict('records')
+
+    listed = []
+    for r in records:
+        host_data = r['Host'].split(':')
+        if len(host_data) == 1:
+            listed.append( (host_data[0], '') )
+        else:
+            protocol, listed_host_name, port = host_data
+            listed.append( (listed_host_name, port) )
+
+    # All distinct names and addresses are looked up once for the whole batch
+    ip_addresses = resolver.resolve( set(name for name, port in listed) )
+    all_ips = set(flatten(ip_addresses.values())) - set(['0.0.0.0'])
+    fqdns = resolver.reverse(all_ips)
+
+    entries = []
+    for r, (listed_host_name, port) in zip(records, listed):
+        ips = ip_addresses[listed_host_name]
+        is_dns = (len(ips) > 1)
+        for ip in ips:
+            entries.append({'Institution': r['Institution'],
+                            'Site': r['Site'],
+                            'Host': fqdns.get(ip, listed_host_name),
+                            'Alias': listed_host_name,
+                            'Ip': ip,
+                            'Port': port,
+                            'IsDNS': is_dns})
+    return entries
+
+def patch_geo_table (geo, MO_view, WN_view, actions, geoip, resolver=None):
+
+    if resolver is None:
+        resolver = HostResolver()
 
     geo_new = geo[~geo.IsDNS].copy()
 
     # Add hosts (along with sites) specified to be added as monitoring view
-    MO_to_add = MO_view[~(MO_view.Host.isin(geo_new.Alias) | MO_view.Host.isin(geo_new.Host))].copy()
-    MO_to_add['Institution'] = MO_to_add.Host.apply(geoip.org_by_name)
-    MO_to_add = pd.DataFrame(flatten(gen_geo_entries(r['Host'], r['Institution'], r['Site']) for r in MO_to_add.to_dict('records')))
-    geo_new = pd.concat([geo_new, MO_to_add], ignore_index=True)
+    if len(MO_view):
+        MO_to_add = MO_view[~(MO_view.Host.isin(geo_new.Alias) | MO_view.Host.isin(geo_new.Host))].copy()
+        MO_to_add['Institution'] = geoip.org_by_addrs(resolver.get_hosts_ipv4_addr(MO_to_add.Host))
+        MO_to_add = pd.DataFrame(gen_geo_entries_batch(MO_to_add, resolver))
+        geo_new = pd.concat([geo_new, MO_to_add], ignore_index=True)
 
     # Remove sites with specified removal action from monitoring view
     geo_new = geo_new[ ~geo_new.Site.isin(actions[actions == '-'].index) ]
 
-    # Remove worker nodes in sites with no action specified
-    for idx, elem in WN_view[ WN_view.Site.isin(geo_new.Site) ].iterrows():
-        sel = ((geo_new.Alias == elem.Host) | (geo_new.Host == elem.Host)) & (geo_new.Site == elem.Site)
-        geo_new = geo_new[~sel]
+    # Remove worker nodes in sites with no action specified, as an anti-join
+    # on (Site, Host) and (Site, Alias)
+    if len(WN_view):
+        wn_keys = set(WN_view.Site + '\t' + WN_view.Host)
+        by_host = (geo_new.Site + '\t' + geo_new.Host).isin(wn_keys)
+        by_alias = (geo_new.Site + '\t' + geo_new.Alias).isin(wn_keys)
+        geo_new = geo_new[ ~(by_host | by_alias) ]
 
     return geo_new
 
 def tag_hosts (dataframe, host_ip_field, squids_institute_sites_map, squids_ip_sites_map, geo, geoip):
 
-    data = dataframe.copy()
+    # Only columns are added, so the input's data can be shared
+    data = dataframe.copy(deep=False)
+    for column in ('IsSquid', 'Sites'):
+        if column in data:
+            del data[column]
 
-    data['IsSquid'] = data[host_ip_field].isin(geo['Ip'])
+    addresses = data[host_ip_field]
+    squid_addresses = geo['Ip']
+    if is_numeric_ip(addresses):
+        squid_addresses = ipv4_to_uint32(squid_addresses)[0]
+    data['IsSquid'] = addresses.isin(squid_addresses)
 
-    data['Sites'] = ''
-    wn_fun = partial(assign_site_workernode, squids_inst_site_map=squids_institute_sites_map,
-                                             geoip=geoip )
     #TODO: Implement IP exception for some French machines
-    data['Sites'] = data[host_ip_field].apply(wn_fun)
+    data['Sites'] = assign_sites_workernodes(addresses, squids_institute_sites_map, geoip)\
+                        .astype('category')
 
     return data
 
+# Get the parent site lists of a whole column of worker nodes through GeoIP
+def assign_sites_workernodes (hosts, squids_inst_site_map, geoip):
+
+    institutions = geoip.org_by_addrs(hosts)
+
+    sites = institutions.map(squids_inst_site_map)
+    unmapped = sites.isnull()
+    sites[unmapped] = institutions[unmapped]
+    if is_numeric_ip(hosts):
+        is_local = hosts == ipv4_to_uint32(['127.0.0.1'])[0][0]
+    else:
+        is_local = hosts.isin(['127.0.0.1', 'localhost', 'localhost6', '::1'])
+    sites[is_local] = 'localhost'
+
+    return sites
+
 # Get a Worker node's parent site list through GeoIP
 def assign_site_workernode (host, squids_inst_site_map, geoip):
 
@@ -278,6 +766,256 @@ def get_dns_addresses (hostname):
     info = socket.getaddrinfo( hostname, 0, socket.AF_INET)
     return set( e[4][0] for e in info )
 
+def map_concurrently (function, items, workers=16, timeout=None):
+
+    # The timeout applies to each call separately. Calls that exceed it are
+    # abandoned (their result is discarded) and a fresh worker takes their
+    # place, so that a single stuck call does not starve the pool.
+
+    items = list(items)
+    tasks = Queue.Queue()
+    for item in items:
+        tasks.put(item)
+    finished = Queue.Queue()
+    in_flight = {}
+    lock = threading.Lock()
+
+    def worker ():
+        while True:
+            try:
+                item = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            with lock:
+                in_flight[item] = time.time()
+            try:
+                value = function(item)
+            except Exception as e:
+                sys.stderr.write("Concurrent call failed for {0}: {1}\n".format(item, e))
+                value = None
+            with lock:
+                in_flight.pop(item, None)
+            finished.put((item, value))
+
+    def start_worker ():
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    for i in range(min(workers, len(items))):
+        start_worker()
+
+    poll = 1.0 if timeout is None else min(1.0, timeout / 4.0)
+    results = {}
+    expired = set()
+    while len(results) + len(expired) < len(items):
+        try:
+            item, value = finished.get(timeout=poll)
+            if item not in expired:
+                results[item] = value
+        except Queue.Empty:
+            pass
+
+        if timeout is not None:
+            now = time.time()
+            with lock:
+                stuck = [ item for item, start in in_flight.items()
+                          if now - start > timeout and item not in expired ]
+            for item in stuck:
+                sys.stderr.write("Concurrent call timed out for {0}.\n".format(item))
+                expired.add(item)
+                start_worker()
+
+    return results
+
+class Stage(object):
+
+    # A step of a run that starts right away in a thread of its own. Any
+    # Stage among its arguments is a dependency: it waits for their results
+    # and is called with them in their place, so steps that do not depend on
+    # each other overlap. A failure is raised again by result(), also from
+    # the stages depending on it. Slots (a semaphore) bound how many stages
+    # sharing them do their work at the same time.
+
+    def __init__ (self, function, *args, **kwargs):
+
+        self.slots = kwargs.pop('slots', None)
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.error = None
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def result (self):
+
+        self.thread.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+        return self.value
+
+    def _run (self):
+
+        try:
+            args = [ resolve_stage(arg) for arg in self.args ]
+            kwargs = dict( (key, resolve_stage(arg)) for key, arg in self.kwargs.items() )
+
+            if self.slots is None:
+                self.value = self.function(*args, **kwargs)
+            else:
+                with self.slots:
+                    self.value = self.function(*args, **kwargs)
+        except Exception:
+            self.error = sys.exc_info()
+
+def resolve_stage (value):
+
+    if isinstance(value, Stage):
+        return value.result()
+
+    return value
+
+class HostResolver(object):
+
+    ipv4_pattern = r'^(?:(?:25[0-5]|2[0-4][0-9]|1?[0-9]?[0-9])\.){3}(?:25[0-5]|2[0-4][0-9]|1?[0-9]?[0-9])$'
+
+    def __init__ (self, cache_file=None, ttl=86400, negative_ttl=3600,
+                  workers=16, timeout=10):
+
+        self.cache_file = os.path.expanduser(cache_file) if cache_file else None
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.workers = workers
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.cache, self.reverse_cache = self._load_cache()
+        self.stats = collections.Counter()
+
+    def resolve (self, hosts):
+
+        now = time.time()
+        resolved = {}
+        to_lookup = []
+
+        with self.lock:
+            for host in set(hosts):
+                if is_a_valid_ip(host):
+                    resolved[host] = [host]
+                    continue
+                entry = self.cache.get(host)
+                if entry and entry[1] > now:
+                    resolved[host] = entry[0]
+                    self.stats['cache_hits'] += 1
+                else:
+                    to_lookup.append(host)
+
+        found = map_concurrently(simple_get_hosts_ipv4_addrs, to_lookup,
+                                 self.workers, self.timeout)
+
+        with self.lock:
+            for host in to_lookup:
+                # Failed and timed out lookups are remembered as negative results
+                ips = found.get(host) or ['0.0.0.0']
+                ttl = self.negative_ttl if ips == ['0.0.0.0'] else self.ttl
+                self.cache[host] = (ips, now + ttl)
+                resolved[host] = ips
+            self.stats['lookups'] += len(to_lookup)
+            self.stats['failures'] += sum( 1 for host in to_lookup
+                                           if resolved[host] == ['0.0.0.0'] )
+
+        return resolved
+
+    def reverse (self, addresses):
+
+        now = time.time()
+        names = {}
+        to_lookup = []
+
+        with self.lock:
+            for address in set(addresses):
+                entry = self.reverse_cache.get(address)
+                if entry and entry[1] > now:
+                    names[address] = entry[0]
+                    self.stats['cache_hits'] += 1
+                else:
+                    to_lookup.append(address)
+
+        found = map_concurrently(socket.getfqdn, to_lookup, self.workers, self.timeout)
+
+        with self.lock:
+            for address in to_lookup:
+                # getfqdn gives back the address itself when it has no name
+                name = found.get(address) or address
+                ttl = self.negative_ttl if name == address else self.ttl
+                self.reverse_cache[address] = (name, now + ttl)
+                names[address] = name
+            self.stats['reverse_lookups'] += len(to_lookup)
+            self.stats['reverse_failures'] += sum( 1 for address in to_lookup
+                                                   if names[address] == address )
+
+        return names
+
+    def expiry (self, hosts=(), addresses=()):
+
+        # When the first of the cached answers for these goes stale
+        with self.lock:
+            entries = [ self.cache.get(host) for host in set(hosts) ] + \
+                      [ self.reverse_cache.get(address) for address in set(addresses) ]
+
+        return min( [ entry[1] for entry in entries if entry ] + [float('inf')] )
+
+    def get_hosts_ipv4_addr (self, hosts):
+
+        hosts = pd.Series(hosts)
+        is_ip = hosts.astype(str).str.contains(self.ipv4_pattern)
+
+        names = hosts[~is_ip]
+        resolved = self.resolve(names.unique())
+        first_ip = dict( (host, ips[0]) for host, ips in resolved.items() )
+
+        addresses = hosts.copy()
+        addresses[~is_ip] = names.map(first_ip)
+
+        return addresses
+
+    def save (self):
+
+        if not self.cache_file:
+            return
+
+        now = time.time()
+        with self.lock:
+            valid = dict( (kind, dict( (name, entry) for name, entry in cache.items()
+                                       if entry[1] > now ))
+                          for kind, cache in (('forward', self.cache),
+                                              ('reverse', self.reverse_cache)) )
+
+        write_atomically(self.cache_file, json.dumps(valid))
+
+    def _load_cache (self):
+
+        if not (self.cache_file and os.path.exists(self.cache_file)):
+            return {}, {}
+
+        try:
+            with open(self.cache_file) as fobj:
+                stored = json.load(fobj)
+        except ValueError:
+            sys.stderr.write("The DNS cache file {0} is corrupt (ignored).\n".format(self.cache_file))
+            return {}, {}
+
+        # Older cache files only hold forward lookups
+        if set(stored.keys()) != set(['forward', 'reverse']):
+            stored = {'forward': stored, 'reverse': {}}
+
+        return tuple( dict( (name, (value, expiry)) for name, (value, expiry)
+                            in stored[kind].items() )
+                      for kind in ('forward', 'reverse') )
+
 def flatten (iterator):
     return list( itertools.chain.from_iterable(iterator) )
 
@@ -329,12 +1067,215 @@ class GeoIPWrapper(object):
         self.org_by_name = partial(safe_geo_fun,
                                    geo_fun=self.geoip.org_by_name)
 
+        self.geoip_db_file = geoip_db_file
+        self.range_table = None
+        self.lock = threading.Lock()
+
+    def org_by_addrs (self, addresses):
+
+        addresses = pd.Series(addresses)
+
+        with self.lock:
+            if self.range_table is None:
+                try:
+                    self.range_table = GeoIPRangeTable(self.geoip_db_file, self.geoip)
+                except (AttributeError, ValueError, IndexError) as e:
+                    message = "Batch GeoIP lookups unavailable ({0}), falling back to single lookups.\n"
+                    sys.stderr.write(message.format(e))
+                    self.range_table = False
+
+        if self.range_table is False:
+            if is_numeric_ip(addresses):
+                addresses = pd.Series(uint32_to_ipv4(addresses.values), index=addresses.index)
+            return addresses.apply(self.org_by_addr)
+
+        return self.range_table.org_by_addrs(addresses)
+
+class GeoIPRangeTable(object):
+
+    # The legacy GeoIP organization databases are a binary trie over the
+    # address bits. It is flattened here into sorted range starts, so that a
+    # whole column of addresses is resolved with one binary search.
+
+    org_editions = (pygeoip.const.ORG_EDITION, pygeoip.const.ISP_EDITION,
+                    pygeoip.const.ASNUM_EDITION)
+
+    def __init__ (self, geoip_db_file, geoip):
+
+        if geoip._databaseType not in self.org_editions:
+            raise ValueError("unsupported database type {0}".format(geoip._databaseType))
+
+        segments = geoip._databaseSegments
+        record_length = geoip._recordLength
+        raw = open(geoip_db_file, 'rb').read()
+
+        # Node records are little-endian pairs of (left, right) child pointers
+        tree_bytes = np.frombuffer(raw, dtype=np.uint8, count=segments*2*record_length)
+        tree_bytes = tree_bytes.reshape(segments, 2, record_length)
+        tree = np.zeros((segments, 2), dtype=np.int64)
+        for j in range(record_length):
+            tree |= tree_bytes[:, :, j].astype(np.int64) << (8 * j)
+
+        starts, records = self._walk_tree(tree, segments)
+
+        # Adjacent ranges pointing to the same record are merged
+        keep = np.concatenate(([True], records[1:] != records[:-1]))
+        starts, records = starts[keep], records[keep]
+
+        unique_records, self.org_index = np.unique(records, return_inverse=True)
+        org_offset = (2 * record_length - 1) * segments
+        self.orgs = np.array([ self._read_org(raw, record, segments, org_offset)
+                               for record in unique_records ], dtype=object)
+        self.starts = starts.astype(np.uint32)
+
+    def org_by_addrs (self, addresses):
+
+        addresses = pd.Series(addresses)
+        numbers, valid = ipv4_to_uint32(addresses)
+
+        position = np.searchsorted(self.starts, numbers, side='right') - 1
+        orgs = self.orgs[self.org_index[position]]
+        orgs[~valid] = 'Unknown'
+
+        return pd.Series(orgs, index=addresses.index)
+
+    def _walk_tree (self, tree, segments):
+
+        # Breadth-first, one level of the trie (i.e. one address bit) at a time
+        nodes = np.zeros(1, dtype=np.int64)
+        prefixes = np.zeros(1, dtype=np.int64)
+        leaf_starts = []
+        leaf_records = []
+
+        for depth in range(31, -1, -1):
+            next_nodes = []
+            next_prefixes = []
+            for bit in (0, 1):
+                children = tree[nodes, bit]
+                child_prefixes = prefixes | (bit << depth)
+                is_leaf = children >= segments
+                leaf_starts.append(child_prefixes[is_leaf])
+                leaf_records.append(children[is_leaf])
+                next_nodes.append(children[~is_leaf])
+                next_prefixes.append(child_prefixes[~is_leaf])
+            nodes = np.concatenate(next_nodes)
+            prefixes = np.concatenate(next_prefixes)
+
+        if len(nodes):
+            raise ValueError("the database trie is deeper than 32 bits")
+
+        starts = np.concatenate(leaf_starts)
+        records = np.concatenate(leaf_records)
+        order = np.argsort(starts, kind='mergesort')
+
+        return starts[order], records[order]
+
+    def _read_org (self, raw, record, segments, org_offset):
+
+        if record == segments:
+            return 'Unknown'
+
+        start = record + org_offset
+        end = raw.find('\0', start, start + pygeoip.const.MAX_ORG_RECORD_LENGTH)
+        org_raw = raw[start:end] if end >= 0 else raw[start:start + pygeoip.const.MAX_ORG_RECORD_LENGTH]
+
+        return safe_geo_fun(org_raw, lambda raw_org: raw_org)
+
+def is_numeric_ip (addresses):
+
+    return np.issubdtype(getattr(addresses, 'dtype', np.object_), np.integer)
+
+def ipv4_to_uint32 (addresses):
+
+    if not len(addresses):
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=bool)
+
+    if is_numeric_ip(addresses):
+        # Already numeric (e.g. after passing through an Int64Index)
+        numbers = np.asarray(addresses).astype(np.uint32)
+        return numbers, np.ones(len(numbers), dtype=bool)
+
+    octets = pd.Series(addresses).astype(str)\
+                                 .str.extract(r'^(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})$',
+                                              expand=True)
+    valid = octets.notnull().all(axis=1).values
+    octets = octets.fillna('0').astype(np.int64).values
+
+    valid &= (octets <= 255).all(axis=1)
+    numbers = (octets[:, 0] << 24) | (octets[:, 1] << 16) | (octets[:, 2] << 8) | octets[:, 3]
+    numbers[~valid] = 0
+
+    return numbers.astype(np.uint32), valid
+
+def uint32_to_ipv4 (numbers):
+
+    numbers = np.asarray(numbers, dtype=np.uint32)
+    if not len(numbers):
+        return np.zeros(0, dtype=object)
+
+    dotted = ((numbers >> 24) & 0xFF).astype(str)
+    for shift in (16, 8, 0):
+        dotted = np.char.add(np.char.add(dotted, '.'), ((numbers >> shift) & 0xFF).astype(str))
+
+    return dotted.astype(object)
+
+# The tables passed between stages share a compact schema: IPv4 addresses are
+# kept as uint32 (with 0 standing for unresolved hosts, as 0.0.0.0 did) and
+# repetitive strings as categoricals. They become plain strings only on output.
+
+host_category_columns = ['Group', 'Sites', 'Site', 'Institution', 'Alias']
+record_category_columns = host_category_columns + ['Host']
+
+def compact_host_table (table, categories=host_category_columns):
+
+    if not isinstance(table, pd.DataFrame):
+        return table
+
+    converted = {}
+    if 'Ip' in table and table['Ip'].dtype != np.uint32:
+        converted['Ip'] = pd.Series(ipv4_to_uint32(table['Ip'])[0], index=table.index)
+    for column in categories:
+        if column in table and not is_categorical(table[column]):
+            # Object categories even when all missing, as pandas can only
+            # concatenate categoricals whose categories share a dtype
+            converted[column] = table[column].astype(object).astype('category')
+
+    # Tables already in the compact schema are passed along as they are
+    if not converted:
+        return table
+
+    columns = collections.OrderedDict( (column, converted.get(column, table[column]))
+                                       for column in table.columns )
+    return pd.DataFrame(columns, index=table.index, columns=table.columns)
+
+def expand_host_table (table):
+
+    columns = collections.OrderedDict()
+    for column in table.columns:
+        values = table[column]
+        if column == 'Ip' and is_numeric_ip(values):
+            values = pd.Series(uint32_to_ipv4(values.values), index=table.index)
+        elif is_categorical(values):
+            values = values.astype(object)
+        columns[column] = values
+
+    return pd.DataFrame(columns, index=table.index, columns=table.columns)
+
+def is_categorical (series):
+
+    return str(series.dtype) == 'category'
+
 class CMSTagger(object):
 
-    def __init__ (self, geo_table, geoip):
+    def __init__ (self, geo_table, geoip, site_maps=None, memo=None):
 
         self.geo = geo_table
         self.geoip = geoip
+        self.memo = memo
+
+        if site_maps is not None:
+            self.squids_ip_sites_map, self.squids_institute_sites_map = site_maps
+            return
 
         valid_squids = ~( (self.geo['Ip'] == '0.0.0.0') | self.geo['IsDNS'] )
         Sqd_Ip_Site_df = self.geo[['Site', 'Ip']][valid_squids]
@@ -344,28 +1285,1040 @@ class CMSTagger(object):
         self.squids_institute_sites_map = self._compact_sites(Sqd_Insti_Site_df)
         self.squids_institute_sites_map['Unknown'] = 'Unknown'
 
+    @property
+    def site_maps (self):
+
+        return self.squids_ip_sites_map, self.squids_institute_sites_map
+
     def tag_hosts (self, data, host_ip_field):
 
-        return tag_hosts( data, host_ip_field, self.squids_institute_sites_map,
-                          self.squids_ip_sites_map, self.geo, self.geoip )
+        if self.memo is None or not is_numeric_ip(data[host_ip_field]):
+            return tag_hosts( data, host_ip_field, self.squids_institute_sites_map,
+                              self.squids_ip_sites_map, self.geo, self.geoip )
 
-    def _compact_sites (self, geo_slice):
+        tagged = data.copy(deep=False)
+        for column in ('IsSquid', 'Sites'):
+            if column in tagged:
+                del tagged[column]
+
+        is_squid, sites = self.memo.tag(tagged[host_ip_field].values, self._tag_addresses)
+        tagged['IsSquid'] = is_squid
+        tagged['Sites'] = sites
+
+        return tagged
+
+    def save_memo (self):
+
+        if self.memo is not None:
+            self.memo.save()
 
-        other_field = geo_slice.columns.diff(['Site'])[0]
-        slice_cp = geo_slice.drop_duplicates()
+    def _tag_addresses (self, addresses):
 
-        x = slice_cp['Site'].str.split('_', 2)
-        slice_cp['BaseSite'] = x.str.get(1) + '_' + x.str.get(2)
-        slice_cp['Tier'] = x.str.get(0)
+        tagged = tag_hosts( pd.DataFrame({'Ip': addresses}), 'Ip', self.squids_institute_sites_map,
+                            self.squids_ip_sites_map, self.geo, self.geoip )
+        return tagged['IsSquid'].values, tagged['Sites']
 
-        z = slice_cp.groupby([other_field, 'BaseSite'])['Tier']
-        w = z.agg( lambda df: ",".join(sorted(df.values)) ).reset_index(level='BaseSite')
-        w['Sites'] = w['Tier'] + '_' + w['BaseSite']
+    def _compact_sites (self, geo_slice):
 
-        compacted = w.groupby(level=other_field)['Sites'].agg( lambda df: "; ".join(sorted(df.values)) )
+        other_field = [ column for column in geo_slice.columns if column != 'Site' ][0]
+
+        parts = geo_slice['Site'].str.split('_', 2)
+        table = pd.DataFrame({'Key': geo_slice[other_field].values,
+                              'Tier': parts.str.get(0).values,
+                              'BaseSite': (parts.str.get(1) + '_' + parts.str.get(2)).values})
+        table = table.dropna().drop_duplicates()\
+                     .sort_values(['Key', 'BaseSite', 'Tier'])
+
+        # The tiers of a site go together, e.g. T1,T2_US_FNAL ...
+        keys, bases = table['Key'].values, table['BaseSite'].values
+        starts = segment_starts(keys, bases)
+        tiers = table['Tier'].tolist()
+        sites = pd.DataFrame({'Key': keys[starts],
+                              'Sites': [ ",".join(tiers[start:end]) + '_' + base for start, end, base
+                                         in zip(starts, list(starts[1:]) + [len(tiers)], bases[starts]) ]})\
+                  .sort_values(['Key', 'Sites'])
+
+        # ... and so do the sites of each key, e.g. T1,T2_US_FNAL; T3_US_FNALLPC
+        keys = sites['Key'].values
+        starts = segment_starts(keys)
+        names = sites['Sites'].tolist()
+        compacted = pd.Series([ "; ".join(names[start:end]) for start, end
+                                in zip(starts, list(starts[1:]) + [len(names)]) ],
+                              index=pd.Index(keys[starts], name=other_field), name='Sites')
 
         return compacted
 
+def segment_starts (*sorted_columns):
+
+    # Positions where the values of any of the (sorted) columns change
+    if not len(sorted_columns[0]):
+        return np.zeros(0, dtype=int)
+
+    changes = np.zeros(len(sorted_columns[0]), dtype=bool)
+    changes[0] = True
+    for values in sorted_columns:
+        changes[1:] |= values[1:] != values[:-1]
+
+    return np.flatnonzero(changes)
+
+class TagMemo(object):
+
+    # What tag_hosts found for each address (as uint32), kept sorted by
+    # address and across runs, so only addresses not seen before are tagged.
+    # It is only valid for the geo table and GeoIP database its key was made
+    # from, and starts empty whenever they change.
+
+    def __init__ (self, memo_file, key):
+
+        self.memo_file = os.path.expanduser(memo_file)
+        self.key = key
+        self.lock = threading.Lock()
+        self.changed = False
+
+        self.addresses = np.zeros(0, dtype=np.uint32)
+        self.is_squid = np.zeros(0, dtype=bool)
+        self.site_codes = np.zeros(0, dtype=np.int32)
+        self.sites = pd.Index([], dtype=object)
+
+        try:
+            with open(self.memo_file, 'rb') as fobj:
+                saved = cPickle.load(fobj)
+        except (IOError, EOFError, cPickle.UnpicklingError, AttributeError, ImportError):
+            return
+        if saved.get('key') == key:
+            self.addresses, self.is_squid, self.site_codes, self.sites = saved['memo']
+
+    def __len__ (self):
+
+        return len(self.addresses)
+
+    def tag (self, addresses, tag_new):
+
+        addresses = np.asarray(addresses, dtype=np.uint32)
+
+        with self.lock:
+            unique = np.unique(addresses)
+            positions = np.minimum(np.searchsorted(self.addresses, unique),
+                                   max(len(self.addresses) - 1, 0))
+            known = np.zeros(len(unique), dtype=bool)
+            if len(self.addresses):
+                known = self.addresses[positions] == unique
+
+            new = unique[~known]
+            if len(new):
+                is_squid, sites = tag_new(new)
+                self._add(new, is_squid, sites)
+
+            positions = np.searchsorted(self.addresses, addresses)
+            return ( self.is_squid[positions],
+                     pd.Categorical.from_codes(self.site_codes[positions], self.sites) )
+
+    def save (self):
+
+        with self.lock:
+            if not self.changed:
+                return
+            memo = (self.addresses, self.is_squid, self.site_codes, self.sites)
+            write_atomically(self.memo_file, cPickle.dumps({'key': self.key, 'memo': memo},
+                                                           cPickle.HIGHEST_PROTOCOL))
+            self.changed = False
+
+    def _add (self, addresses, is_squid, sites):
+
+        sites = pd.Series(np.asarray(sites, dtype=object))
+        names = pd.Index(sites.dropna().unique())
+        self.sites = self.sites.append(names.difference(self.sites))
+
+        merged = np.concatenate([self.addresses, addresses])
+        order = np.argsort(merged, kind='mergesort')
+        self.addresses = merged[order]
+        self.is_squid = np.concatenate([self.is_squid, is_squid])[order]
+        self.site_codes = np.concatenate([self.site_codes,
+                                          self.sites.get_indexer(sites).astype(np.int32)])[order]
+        self.changed = True
+
+class RecordStore(object):
+
+    # Failover records are kept in one pickled frame per time partition,
+    # next to a header-less CSV fragment of the same rows. Appending only
+    # touches the current partition, expiring deletes whole partitions and
+    # the dashboard CSV is exported by concatenating fragments.
+
+    partition_tpl = 'records-{0:d}.{1}'
+
+    def __init__ (self, directory, partition_span=3600):
+
+        self.directory = os.path.expanduser(directory)
+        self.partition_span = partition_span
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def partitions (self, start=None, end=None):
+
+        starts = []
+        for file_path in glob.glob(os.path.join(self.directory, 'records-*.pickle')):
+            name = os.path.basename(file_path)
+            try:
+                starts.append( int(name[len('records-'):-len('.pickle')]) )
+            except ValueError:
+                continue
+
+        if start is not None:
+            starts = [ p for p in starts if p + self.partition_span > start ]
+        if end is not None:
+            starts = [ p for p in starts if p <= end ]
+
+        return sorted(starts)
+
+    def is_empty (self):
+
+        return not self.partitions()
+
+    def append (self, records, float_format="%.2f"):
+
+        if records is None or not len(records):
+            return
+
+        partition_of = records['Timestamp'] - records['Timestamp'] % self.partition_span
+
+        for partition, new_rows in records.groupby(partition_of):
+            stored = self._load_partition(partition)
+            if stored is not None:
+                # Re-appending a timestamp replaces its rows
+                stored = stored[ ~stored['Timestamp'].isin(new_rows['Timestamp']) ]
+                new_rows = pd.concat([stored, new_rows], ignore_index=True)
+
+            # Pickled in the compact schema, the CSV fragment with plain strings
+            new_rows = compact_host_table(new_rows.reset_index(drop=True),
+                                          record_category_columns)
+            fragment = expand_host_table(new_rows).to_csv(None, index=False, header=False,
+                                                          float_format=float_format)
+            write_atomically(self._path(partition, 'csv'), fragment)
+            write_atomically(self._path(partition, 'pickle'),
+                             cPickle.dumps(new_rows, cPickle.HIGHEST_PROTOCOL))
+
+    def read (self, start=None, end=None, groups=None):
+
+        frames = [ self._load_partition(p) for p in self.partitions(start, end) ]
+        frames = [ f for f in frames if f is not None ]
+        if not frames:
+            return None
+
+        # Categories differ among partitions, so the schema is restored after merging
+        records = compact_host_table(pd.concat(frames, ignore_index=True),
+                                     record_category_columns)
+        if start is not None:
+            records = records[ records['Timestamp'] >= start ]
+        if end is not None:
+            records = records[ records['Timestamp'] <= end ]
+        if groups is not None:
+            records = records[ records['Group'].isin(groups) ]
+
+        return records
+
+    def expire (self, cutoff):
+
+        for partition in self.partitions():
+            if partition + self.partition_span <= cutoff:
+                for extension in ('pickle', 'csv'):
+                    file_path = self._path(partition, extension)
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+
+    def export_csv (self, file_path, columns, start=None, float_format="%.2f"):
+
+        temp_file = file_path + '.tmp'
+        with open(temp_file, 'w') as fobj:
+            fobj.write(','.join(columns) + '\n')
+
+            for partition in self.partitions(start):
+                if start is not None and partition < start:
+                    # Only the partition straddling the cutoff needs filtering
+                    rows = self._load_partition(partition)
+                    rows = rows[ rows['Timestamp'] >= start ]
+                    fobj.write(expand_host_table(rows.reindex(columns=columns))
+                                   .to_csv(None, index=False, header=False,
+                                           float_format=float_format))
+                else:
+                    with open(self._path(partition, 'csv')) as fragment:
+                        fobj.write(fragment.read())
+
+        os.rename(temp_file, file_path)
+
+    def _path (self, partition, extension):
+
+        return os.path.join(self.directory, self.partition_tpl.format(partition, extension))
+
+    def _load_partition (self, partition):
+
+        file_path = self._path(partition, 'pickle')
+        try:
+            with open(file_path, 'rb') as fobj:
+                return cPickle.load(fobj)
+        except IOError:
+            # Missing, or expired meanwhile by another thread
+            return None
+
+snapshot_counter_columns = ['Hits', 'Bandwidth']
+
+def host_snapshot (table, counters=snapshot_counter_columns):
+
+    hosts = np.asarray(table['Host']).astype(str)
+    fields = [('Ip', '<u4'), ('Host', hosts.dtype.str)]
+    fields += [ (column, '<i8') for column in counters ]
+
+    snapshot = np.empty(len(table), dtype=fields)
+    snapshot['Ip'] = ipv4_to_uint32(table['Ip'])[0]
+    snapshot['Host'] = hosts
+    for column in counters:
+        snapshot[column] = table[column]
+
+    # Sorted by host name, so that joins against it are binary searches
+    snapshot.sort(order=['Host'])
+    return snapshot
+
+def snapshot_counters (snapshot, table, counters=snapshot_counter_columns):
+
+    found_counters = dict( (column, np.zeros(len(table), dtype=np.int64))
+                           for column in counters )
+    if snapshot is None or not len(snapshot) or not len(table):
+        return found_counters
+
+    # Hosts are keyed by name only: the address is the one resolved when the
+    # snapshot was taken, and may have changed since (e.g. a host that did not
+    # resolve then), which must not make its whole count look new
+    stored = np.asarray(snapshot['Host'])
+    order = None
+    if len(stored) > 1 and not (stored[:-1] <= stored[1:]).all():
+        # Snapshots saved before were sorted by address first
+        order = np.argsort(stored, kind='mergesort')
+        stored = stored[order]
+
+    hosts = np.asarray(table['Host']).astype(str)
+    positions = np.minimum(np.searchsorted(stored, hosts), len(stored) - 1)
+    # Names too long for the stored field would match on their prefix
+    found = ( (stored[positions] == hosts) &
+              (np.char.str_len(hosts) <= snapshot.dtype['Host'].itemsize) )
+
+    if order is not None:
+        positions = order[positions]
+    for column in counters:
+        found_counters[column][found] = snapshot[column][positions[found]]
+
+    return found_counters
+
+class SnapshotStore(object):
+
+    # The awstats counters of each group are kept as one binary snapshot per
+    # run (a sorted structured array in an .npy file), along with the
+    # addresses they were resolved to. Loading the last one is then a memory
+    # map, with no parsing nor DNS lookups, and only the last few are kept.
+
+    snapshot_tpl = '{0}-{1:d}.npy'
+
+    def __init__ (self, directory='snapshots', keep=3):
+
+        self.directory = os.path.expanduser(directory)
+        self.keep = max(1, keep)
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def timestamps (self, name):
+
+        timestamps = []
+        for file_path in glob.glob(os.path.join(self.directory, name + '-*.npy')):
+            stamp = os.path.basename(file_path)[len(name) + 1:-len('.npy')]
+            try:
+                timestamps.append( int(stamp) )
+            except ValueError:
+                continue
+
+        return sorted(timestamps)
+
+    def load (self, name, timestamp=None):
+
+        if timestamp is None:
+            timestamps = self.timestamps(name)
+            if not timestamps:
+                return None, None
+            timestamp = timestamps[-1]
+
+        try:
+            return timestamp, np.load(self._path(name, timestamp), mmap_mode='r')
+        except IOError:
+            return None, None
+
+    def save (self, name, table, timestamp):
+
+        file_path = self._path(name, timestamp)
+        temp_file = file_path + '.tmp'
+        with open(temp_file, 'wb') as fobj:
+            np.save(fobj, host_snapshot(table))
+        os.rename(temp_file, file_path)
+
+        for old_timestamp in self.timestamps(name)[:-self.keep]:
+            os.remove(self._path(name, old_timestamp))
+
+    def _path (self, name, timestamp):
+
+        return os.path.join(self.directory, self.snapshot_tpl.format(name, int(timestamp)))
+
+def wait_periods (gaps, period=3600):
+
+    # The runs missed between two failover records of a site, 0 meaning that
+    # they come from consecutive runs
+    return np.round(np.asarray(gaps, dtype=float) / period).astype(int) - 1
+
+class SiteTracker(object):
+
+    # Keeps, for each site, the last run it was recorded failing over in, for
+    # how many consecutive runs it has been, the first record of its latest
+    # pair of consecutive ones (i.e. when it last failed over persistently)
+    # and when it was last notified. Each run only updates the sites in its
+    # own records, so deciding on emails does not take the whole history.
+
+    columns = ['LastSeen', 'Streak', 'PersistentFrom', 'LastNotified']
+
+    def __init__ (self, state_file='site-state.csv', period=3600):
+
+        self.state_file = os.path.expanduser(state_file)
+        self.period = period
+
+        self.restored = os.path.exists(self.state_file)
+        if self.restored:
+            self.table = pd.read_csv(self.state_file, index_col='Sites')\
+                           .reindex(columns=self.columns).astype(float)
+        else:
+            self.table = self._empty()
+
+    def rebuild (self, records, notifications=()):
+
+        # From the recorded history, as if it had been tracked all along
+        self.table = self._empty()
+        seen = expand_host_table(records[['Sites', 'Timestamp']]).drop_duplicates()
+        for timestamp, rows in seen.groupby('Timestamp'):
+            self.update(rows['Sites'], timestamp)
+        self.notified(notifications)
+        self.restored = True
+
+    def update (self, sites, now_timestamp):
+
+        sites = pd.Index(pd.unique(np.asarray(sites, dtype=object)))
+        rows = self.table.reindex(sites)
+        # Timestamps already tracked are not counted twice
+        rows = rows[ ~(rows['LastSeen'] >= now_timestamp).values ]
+        if not len(rows):
+            return
+
+        seen = rows['LastSeen'].notnull().values
+        gaps = np.where(seen, now_timestamp - rows['LastSeen'].values, 0)
+        persistent = seen & (wait_periods(gaps, self.period) == 0)
+
+        rows['Streak'] = np.where(persistent, rows['Streak'].values + 1, 1)
+        rows['PersistentFrom'] = np.where(persistent, rows['LastSeen'].values,
+                                          rows['PersistentFrom'].values)
+        rows['LastSeen'] = now_timestamp
+        self._merge(rows)
+
+    def notified (self, notifications):
+
+        if not len(notifications):
+            return
+
+        sent = pd.DataFrame.from_records(list(notifications), columns=['Sites', 'Timestamp'])\
+                           .groupby('Sites')['Timestamp'].max()
+        rows = self.table.reindex(sent.index)
+        rows['LastNotified'] = np.fmax(rows['LastNotified'].values, sent.values)
+        self._merge(rows)
+
+    def persistent_sites (self, now_timestamp, window):
+
+        start_of_window = now_timestamp - window*3600
+        return self.table.index[ (self.table['PersistentFrom'] >= start_of_window).values ].tolist()
+
+    def notified_sites (self, now_timestamp, window):
+
+        start_of_window = now_timestamp - window*3600
+        return set(self.table.index[ (self.table['LastNotified'] >= start_of_window).values ])
+
+    def expire (self, cutoff):
+
+        keep = (self.table['LastSeen'] >= cutoff) | (self.table['LastNotified'] >= cutoff)
+        self.table = self.table[keep.values]
+
+    def save (self):
+
+        write_atomically(self.state_file, self.table.to_csv(None, index_label='Sites',
+                                                            float_format='%.0f'))
+
+    def _merge (self, rows):
+
+        self.table = pd.concat([self.table.drop(rows.index, errors='ignore'), rows])
+        self.table.index.name = 'Sites'
+
+    def _empty (self):
+
+        table = pd.DataFrame(columns=self.columns, dtype=float)
+        table.index.name = 'Sites'
+        return table
+
+class MailQueue(object):
+
+    # Messages are written to the outbox before being queued, and only removed
+    # from it once the SMTP server accepts them. Whatever is left over (e.g.
+    # after the server was down) is sent again when the queue next starts.
+    # A message is claimed by renaming it before it is sent, so that no other
+    # delivery thread (of this queue or another one) can send it as well.
+    # Claims still held when the queue is closed are given back to the outbox.
+
+    claim_suffix = '.sending'
+
+    def __init__ (self, directory='outbox', host='localhost', port=25, rate=1.0,
+                  max_attempts=4, backoff=5, debug=False, claim_timeout=3600):
+
+        self.directory = os.path.expanduser(directory)
+        self.failed_directory = os.path.join(self.directory, 'failed')
+        self.host = host
+        self.port = port
+        self.interval = 1.0 / rate if rate else 0
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.debug = debug
+        self.claim_timeout = claim_timeout
+
+        for directory in (self.directory, self.failed_directory):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        self.queue = Queue.Queue()
+        self.delivered = []
+        self.lock = threading.RLock()
+        self.claimed = set()
+        self.closing = False
+        self.smtp = None
+        self.thread = None
+
+    def start (self):
+
+        with self.lock:
+            self.closing = False
+
+        # Claims left behind by a delivery that died are given up
+        now = time.time()
+        for claimed_file in self._outbox_files(claimed=True):
+            try:
+                if now - os.path.getmtime(claimed_file) > self.claim_timeout:
+                    os.rename(claimed_file, claimed_file[:-len(self.claim_suffix)])
+            except OSError:
+                continue
+
+        # Messages already queued are skipped once claimed, so a queue can be
+        # started again (e.g. on every daemon cycle) to pick up the leftovers
+        for entry_file in self._outbox_files():
+            self.queue.put(entry_file)
+
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._deliver)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def notifications (self):
+
+        # Messages delivered by this queue and not taken yet, plus those still
+        # in the outbox or being sent
+        with self.lock:
+            notifications = list(self.delivered)
+            for entry_file in self._outbox_files() + self._outbox_files(claimed=True):
+                try:
+                    notifications.append(json.load(open(entry_file))['meta'])
+                except (IOError, ValueError):
+                    continue
+
+        return notifications
+
+    def enqueue (self, sender, recipients, message, meta):
+
+        entry = {'sender': sender, 'recipients': recipients,
+                 'message': message, 'meta': meta}
+        name = '{0:d}-{1}.json'.format(int(time.time() * 1e6),
+                                       hashlib.sha1(message).hexdigest()[:12])
+        entry_file = os.path.join(self.directory, name)
+        write_atomically(entry_file, json.dumps(entry))
+
+        self.queue.put(entry_file)
+
+    def flush (self, timeout=300):
+
+        # Waits for the messages queued so far, and takes those delivered
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+        if not done.is_set():
+            sys.stderr.write("Email delivery did not finish in time, the rest stays in the outbox.\n")
+
+        return self._take_delivered()
+
+    def close (self, timeout=300):
+
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                sys.stderr.write("Email delivery did not finish in time, the rest stays in the outbox.\n")
+                self._release_claims()
+
+        return self._take_delivered()
+
+    def _release_claims (self):
+
+        # The process may exit before the delivery thread is done, and its
+        # claims would hold those messages back from the next run
+        with self.lock:
+            self.closing = True
+            for claimed_file in self.claimed:
+                try:
+                    os.rename(claimed_file, claimed_file[:-len(self.claim_suffix)])
+                except OSError:
+                    continue
+            self.claimed = set()
+
+    def _take_delivered (self):
+
+        with self.lock:
+            delivered, self.delivered = self.delivered, []
+
+        return delivered
+
+    def _outbox_files (self, claimed=False):
+
+        pattern = '*.json' + (self.claim_suffix if claimed else '')
+        return sorted(glob.glob(os.path.join(self.directory, pattern)))
+
+    def _claim (self, entry_file):
+
+        claimed_file = entry_file + self.claim_suffix
+        try:
+            with self.lock:
+                if self.closing:
+                    return None
+                os.rename(entry_file, claimed_file)
+                self.claimed.add(claimed_file)
+            os.utime(claimed_file, None)
+        except OSError:
+            # Sent, or being sent, by some other delivery
+            return None
+
+        return claimed_file
+
+    def _move (self, source, destination):
+
+        try:
+            with self.lock:
+                if source in self.claimed:
+                    self.claimed.remove(source)
+                elif source.endswith(self.claim_suffix):
+                    # Given back to the outbox while it was being sent
+                    source = source[:-len(self.claim_suffix)]
+                    if source == destination:
+                        return
+                if destination is None:
+                    os.remove(source)
+                else:
+                    os.rename(source, destination)
+        except OSError as e:
+            sys.stderr.write("Could not move outbox file {0}: {1}\n".format(source, e))
+
+    def _deliver (self):
+
+        last_sent = 0
+        while True:
+            entry_file = self.queue.get()
+            if entry_file is None:
+                break
+            if not isinstance(entry_file, basestring):
+                # A batch ends here, no need to keep the session open
+                self._disconnect()
+                entry_file.set()
+                continue
+
+            claimed_file = self._claim(entry_file)
+            if claimed_file is None:
+                continue
+            failed_file = os.path.join(self.failed_directory, os.path.basename(entry_file))
+
+            try:
+                entry = json.load(open(claimed_file))
+                missing = set(['sender', 'recipients', 'message', 'meta']) - set(entry)
+                if missing:
+                    raise ValueError("missing {0}".format(', '.join(sorted(missing))))
+            except (IOError, ValueError, TypeError) as e:
+                sys.stderr.write("Email {0} is unreadable: {1}\n".format(entry_file, e))
+                self._move(claimed_file, failed_file)
+                continue
+
+            for attempt in range(self.max_attempts):
+                time.sleep(max(0, last_sent + self.interval - time.time()))
+                try:
+                    self._connection().sendmail(entry['sender'], entry['recipients'],
+                                                entry['message'])
+                    last_sent = time.time()
+                    # Together, so that it is never both delivered and pending
+                    with self.lock:
+                        self.delivered.append(entry['meta'])
+                        self._move(claimed_file, None)
+                    print "\nSuccessfully sent email to:", ', '.join(entry['recipients'])
+                    break
+
+                except (smtplib.SMTPException, socket.error) as e:
+                    self._disconnect()
+                    if self._is_permanent(e):
+                        sys.stderr.write("Email {0} rejected: {1}\n".format(entry_file, e))
+                        self._move(claimed_file, failed_file)
+                        break
+                    sys.stderr.write("Email {0} not sent yet: {1}\n".format(entry_file, e))
+                    if attempt + 1 < self.max_attempts:
+                        time.sleep(self.backoff * 2**attempt)
+            else:
+                # Back to the outbox, for the next start to try again
+                self._move(claimed_file, entry_file)
+
+        self._disconnect()
+
+    def _connection (self):
+
+        # One session is reused for the whole batch
+        if self.smtp is None:
+            self.smtp = smtplib.SMTP(self.host, self.port)
+            self.smtp.set_debuglevel(self.debug)
+
+        return self.smtp
+
+    def _disconnect (self):
+
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.smtp = None
+
+    def _is_permanent (self, error):
+
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all( code >= 500 for code, message in error.recipients.values() )
+        if isinstance(error, smtplib.SMTPResponseException):
+            return error.smtp_code >= 500
+
+        return False
+
+rollup_columns = ["Timestamp", "Group", "Sites", "IsSquid", "Hosts",
+                  "Hits", "HitsRate", "Bandwidth", "BandwidthRate"]
+
+def rollup_records (records, bucket_span):
+
+    bucket = (records['Timestamp'] // bucket_span).rename('Bucket')
+
+    # Every bucket is stamped with its latest record, so that the timestamps
+    # keep pointing to the end of a period as they do in the raw record.
+    rollup = records.groupby([bucket, 'Group', 'Sites', 'IsSquid'])\
+                  .agg({'Timestamp': np.max, 'Host': 'count',
+                        'Hits': np.sum, 'HitsRate': np.sum,
+                        'Bandwidth': np.sum, 'BandwidthRate': np.sum})
+    rollup = rollup.rename(columns={'Host': 'Hosts'}).reset_index()
+
+    return rollup.reindex(columns=rollup_columns)
+
+def filter_records (records, start=None, end=None, sites=None, groups=None, squid=None):
+
+    # Only the criteria applicable to the record's columns are used,
+    # so that failover and email records can be filtered alike.
+    mask = pd.Series(True, index=records.index)
+
+    if start is not None:
+        mask &= records['Timestamp'] >= start
+    if end is not None:
+        mask &= records['Timestamp'] <= end
+    if sites and 'Sites' in records:
+        # Records may list several sites, separated by "; "
+        padded = '; ' + records['Sites'].astype(str) + '; '
+        site_mask = pd.Series(False, index=records.index)
+        for site in sites:
+            site_mask |= padded.str.contains('; ' + site + '; ', regex=False)
+        mask &= site_mask
+    if groups and 'Group' in records:
+        mask &= records['Group'].isin(groups)
+    if squid is not None and 'IsSquid' in records:
+        mask &= records['IsSquid'].astype(str) == str(squid)
+
+    return records[mask]
+
+def gzip_bytes (data):
+
+    buffer = StringIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as compressed:
+        compressed.write(data)
+
+    return buffer.getvalue()
+
+class RecordQueryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    # Answers queries on the failover and email records, e.g.
+    #   /records?start=1420070400&site=T2_CH_CERN&squid=False&view=aggregated
+    # Responses are kept gzipped in memory; their ETags change with every
+    # run of the monitor, i.e. whenever the records may have changed.
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__ (self, address, sources, version, cache_entries=64):
+
+        BaseHTTPServer.HTTPServer.__init__(self, address, RecordQueryHandler)
+
+        self.sources = sources              # Name -> function(start, end)
+        self.version = version              # Function giving the last run's timestamp
+        self.cache_entries = cache_entries
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def response (self, etag, build):
+
+        with self.lock:
+            if etag in self.cache:
+                return self.cache[etag]
+
+        body = gzip_bytes(build())
+
+        with self.lock:
+            self.cache[etag] = body
+            while len(self.cache) > self.cache_entries:
+                self.cache.popitem(last=False)
+
+        return body
+
+class RecordQueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    content_types = {'csv': 'text/csv', 'json': 'application/json'}
+
+    def do_GET (self):
+
+        url = urlparse.urlparse(self.path)
+        name = url.path.strip('/')
+        if name not in self.server.sources:
+            return self.send_error(404, "Unknown record: " + name)
+
+        try:
+            query = parse_record_query(url.query)
+        except ValueError as error:
+            return self.send_error(400, str(error))
+
+        etag = '"{0}-{1}"'.format(self.server.version(),
+                                  hashlib.sha1(name + '?' + url.query).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        def build ():
+            records = self.server.sources[name](query['start'], query['end'])
+            return format_record_query(records, query)
+
+        body = self.server.response(etag, build)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            encoding = 'gzip'
+        else:
+            encoding = None
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+
+        self.send_response(200)
+        self.send_header('Content-Type', self.content_types[query['format']])
+        self.send_header('Content-Length', str(len(body)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+def parse_record_query (query_string):
+
+    params = urlparse.parse_qs(query_string)
+
+    def single (name, convert, default=None):
+        if name not in params:
+            return default
+        try:
+            return convert(params[name][-1])
+        except ValueError:
+            raise ValueError("Invalid value for '{0}': {1}".format(name, params[name][-1]))
+
+    def boolean (value):
+        if value.lower() not in ('true', 'false'):
+            raise ValueError(value)
+        return value.lower() == 'true'
+
+    query = {'start': single('start', int),
+             'end': single('end', int),
+             'sites': params.get('site', []),
+             'groups': params.get('group', []),
+             'squid': single('squid', boolean),
+             'view': single('view', str, 'raw'),
+             'bucket': single('bucket', int, 60),            # Unit: minutes
+             'format': single('format', str, 'csv')}
+
+    if query['view'] not in ('raw', 'aggregated'):
+        raise ValueError("Unknown view: " + query['view'])
+    if query['format'] not in RecordQueryHandler.content_types:
+        raise ValueError("Unknown format: " + query['format'])
+    if query['bucket'] <= 0:
+        raise ValueError("The bucket must be positive")
+
+    return query
+
+def format_record_query (records, query):
+
+    if records is None or not len(records):
+        return '[]' if query['format'] == 'json' else ''
+
+    selection = filter_records(records, query['start'], query['end'], query['sites'],
+                               query['groups'], query['squid'])
+    selection = expand_host_table(selection)
+    if query['view'] == 'aggregated' and 'Host' in selection:
+        selection = rollup_records(selection, 60 * query['bucket'])
+
+    if query['format'] == 'json':
+        return selection.to_json(orient='records')
+
+    return selection.to_csv(None, index=False, float_format="%.2f")
+
+class RunMetrics(object):
+
+    # Named stage timers of a monitor run, with row counts and the peak
+    # memory when each stage ended, plus free-form counters (e.g. DNS cache
+    # hits). Stages may be timed from several threads at once.
+
+    def __init__ (self, prefix='failover'):
+
+        self.prefix = prefix
+        self.started = time.time()
+        self.stages = []
+        self.counters = collections.OrderedDict()
+        self.descriptions = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage (self, name, group=None):
+
+        entry = {'stage': name, 'group': group, 'rows': None}
+        start = time.time()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] = time.time() - start
+            entry['peak_memory'] = peak_memory()
+            with self.lock:
+                self.stages.append(entry)
+
+    def describe (self, name, description):
+
+        self.descriptions[name] = description
+
+    def count (self, name, value, **labels):
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = value
+
+    def count_changes (self, name, before, after, label='result'):
+
+        for key in set(before) | set(after):
+            self.count(name, after.get(key, 0) - before.get(key, 0), **{label: key})
+
+    def extend (self, other):
+
+        with self.lock:
+            self.stages.extend(other.stages)
+            self.counters.update(other.counters)
+            self.descriptions.update(other.descriptions)
+
+    def summary (self):
+
+        with self.lock:
+            return {'started': int(self.started),
+                    'seconds': time.time() - self.started,
+                    'peak_memory': peak_memory(),
+                    'peak_memory_children': peak_memory(resource.RUSAGE_CHILDREN),
+                    'stages': list(self.stages),
+                    'counters': [ dict(labels, name=name, value=value)
+                                  for (name, labels), value in self.counters.items() ]}
+
+    def write_json (self, file_path):
+
+        self._write(file_path, json.dumps(self.summary(), indent=3, sort_keys=True))
+
+    def write_prometheus (self, file_path):
+
+        summary = self.summary()
+        lines = []
+
+        def metric (name, help_text, samples):
+            name = '{0}_{1}'.format(self.prefix, name)
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} gauge'.format(name))
+            for labels, value in samples:
+                lines.append('{0}{1} {2}'.format(name, prometheus_labels(labels), value))
+
+        metric('run_timestamp_seconds', "Start of the last run.",
+               [ ({}, summary['started']) ])
+        metric('run_duration_seconds', "Wall time of the last run.",
+               [ ({}, '{0:.3f}'.format(summary['seconds'])) ])
+        metric('peak_memory_bytes', "Peak resident memory of the monitor process.",
+               [ ({'process': 'self'}, summary['peak_memory']),
+                 ({'process': 'children'}, summary['peak_memory_children']) ])
+
+        stage_labels = [ dict( (k, v) for k, v in (('stage', e['stage']), ('group', e['group']))
+                               if v is not None ) for e in summary['stages'] ]
+        metric('stage_duration_seconds', "Wall time of each stage of the last run.",
+               [ (labels, '{0:.3f}'.format(e['seconds']))
+                 for labels, e in zip(stage_labels, summary['stages']) ])
+        metric('stage_rows', "Rows produced by each stage of the last run.",
+               [ (labels, e['rows'])
+                 for labels, e in zip(stage_labels, summary['stages']) if e['rows'] is not None ])
+
+        by_name = collections.OrderedDict()
+        for (name, labels), value in self.counters.items():
+            by_name.setdefault(name, []).append( (dict(labels), value) )
+        for name, samples in by_name.items():
+            metric(name, self.descriptions.get(name, "Counted during the last run."), samples)
+
+        self._write(file_path, '\n'.join(lines) + '\n')
+
+    def _write (self, file_path, data):
+
+        file_path = os.path.expanduser(file_path)
+        directory = os.path.dirname(file_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        write_atomically(file_path, data)
+
+def prometheus_labels (labels):
+
+    if not labels:
+        return ''
+
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join( '{0}="{1}"'.format(k, escape(v)) for k, v in sorted(labels.items()) ) + '}'
+
+def peak_memory (who=resource.RUSAGE_SELF):
+
+    # ru_maxrss is given in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss * 1024
+
 def cms_site_name_split (site_name):
 
     parts = site_name.split('_', 3)
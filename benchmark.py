@@ -0,0 +1,365 @@
+#! /usr/bin/env python
+
+# Times every stage of the failover detection pipeline on synthetic inputs.
+# DNS and SMTP are replaced by deterministic stand-ins, so it runs offline.
+# Each run is appended as one JSON line to the output file, to be compared
+# with earlier runs.
+
+import argparse
+import imp
+import json
+import os
+import platform
+import re
+import shutil
+import smtplib
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import FailoverLib as fl
+
+my_path = os.path.dirname(os.path.abspath(__file__))
+hm = imp.load_source('hourly_monitor', os.path.join(my_path, 'hourly-monitor.py'))
+
+def main():
+
+    args = parse_arguments()
+
+    install_network_stubs()
+
+    work_dir = tempfile.mkdtemp(prefix='failover-benchmark-')
+    results = []
+    try:
+        for hosts in args.hosts:
+            sys.stderr.write("Benchmarking with {0:d} hosts...\n".format(hosts))
+            size_dir = os.path.join(work_dir, str(hosts))
+            os.makedirs(size_dir)
+            results.extend( run_benchmark(hosts, args.days, args.instances,
+                                          args.workers, size_dir, args.seed) )
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, True)
+
+    run = {'timestamp': int(time.time()),
+           'revision': git_revision(),
+           'python': platform.python_version(),
+           'numpy': np.__version__,
+           'pandas': pd.__version__,
+           'days': args.days,
+           'instances': args.instances,
+           'results': results}
+
+    with open(args.output, 'a') as fobj:
+        fobj.write(json.dumps(run, sort_keys=True) + '\n')
+
+    report = pd.DataFrame(results).pivot(index='stage', columns='hosts', values='seconds')
+    print report.reindex(stages).to_string(float_format=lambda x: '%.3f' % x)
+
+    return 0
+
+def parse_arguments ():
+
+    parser = argparse.ArgumentParser(description="Benchmarks the failover detection "
+                                                 "pipeline on synthetic data.")
+    parser.add_argument('--hosts', type=lambda s: [ int(n) for n in s.split(',') ],
+                        default=[1000, 10000, 100000, 1000000],
+                        help="Comma separated amounts of awstats hosts to try")
+    parser.add_argument('--days', type=int, default=3,
+                        help="Span of the synthetic failover record")
+    parser.add_argument('--instances', type=int, default=2,
+                        help="Awstats instances (i.e. files) per server group")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Processes reading awstats files concurrently")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='benchmark-results.jsonl')
+    parser.add_argument('--keep', action='store_true',
+                        help="Keep the synthetic inputs (their location is printed)")
+
+    return parser.parse_args()
+
+# Synthetic addressing: site number s owns the network 100+s/256 . s%256 .0.0/16,
+# its institution is "Inst<s>", its squids are sq<k>.s<s>.example.org and its
+# worker nodes are wn<i>.s<s>.example.org.
+
+host_name_re = re.compile(r'^(sq|wn|mon)(\d+)\.s(\d+)\.example\.org$')
+
+def site_network (site):
+
+    return 100 + site // 256, site % 256
+
+def synthetic_address (kind, number, site):
+
+    a, b = site_network(site)
+    if kind == 'wn':
+        return '{0}.{1}.{2}.{3}'.format(a, b, number // 250, 1 + number % 250)
+    # Squids and monitoring hosts live in the top of the network
+    offset = 0 if kind == 'sq' else 128
+    return '{0}.{1}.255.{2}'.format(a, b, offset + number)
+
+def install_network_stubs ():
+
+    def getaddrinfo (host, port, *args):
+        match = host_name_re.match(host)
+        if match is None:
+            if fl.is_a_valid_ip(host):
+                return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (host, port))]
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        kind, number, site = match.group(1), int(match.group(2)), int(match.group(3))
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                 (synthetic_address(kind, number, site), port))]
+
+    def getfqdn (name=''):
+        parts = name.split('.')
+        if len(parts) == 4 and parts[2] == '255':
+            site = (int(parts[0]) - 100) * 256 + int(parts[1])
+            number = int(parts[3])
+            kind = 'sq' if number < 128 else 'mon'
+            return '{0}{1:d}.s{2:d}.example.org'.format(kind, number % 128, site)
+        return name
+
+    socket.getaddrinfo = getaddrinfo
+    socket.getfqdn = getfqdn
+    smtplib.SMTP = DiscardingSMTP
+
+class DiscardingSMTP(object):
+
+    sent = 0
+
+    def __init__ (self, host='', port=0, *args, **kwargs):
+        pass
+
+    def set_debuglevel (self, level):
+        pass
+
+    def sendmail (self, sender, recipients, message):
+        DiscardingSMTP.sent += 1
+        return {}
+
+    def quit (self):
+        pass
+
+class SyntheticGeoIP(object):
+
+    # Stands in for GeoIPWrapper, following the synthetic addressing
+
+    def org_by_addrs (self, addresses):
+
+        addresses = pd.Series(addresses)
+        numbers, valid = fl.ipv4_to_uint32(addresses)
+        sites = (numbers.astype(np.int64) >> 16) - 100 * 256
+        orgs = np.char.add('Inst', sites.astype(str)).astype(object)
+        orgs[~valid | (sites < 0)] = 'Unknown'
+
+        return pd.Series(orgs, index=addresses.index)
+
+    def org_by_addr (self, address):
+
+        return self.org_by_addrs([address]).iloc[0]
+
+    def org_by_name (self, name):
+
+        return self.org_by_addr(fl.get_host_ipv4_addr(name))
+
+def site_name (site):
+
+    return 'T2_XX_Site{0:d}'.format(site)
+
+def gen_geolist (sites):
+
+    lines = []
+    for site in range(sites):
+        proxies = '|'.join( 'http://sq{0:d}.s{1:d}.example.org:3128'.format(k, site)
+                            for k in range(2) )
+        lines.append( 'Directory /Inst{0:d}> S {1} P {2};DIRECT E'.format(site, site_name(site),
+                                                                          proxies) )
+    return '\n'.join(lines) + '\n'
+
+def gen_exceptionlist (sites):
+
+    lines = ['# Synthetic exception list']
+    for site in range(0, sites, 10):
+        lines.append( '{0} +mon0.s{1:d}.example.org'.format(site_name(site), site) )
+    for site in range(5, sites, 10):
+        lines.append( '{0} -sq1.s{1:d}.example.org'.format(site_name(site), site) )
+    for site in range(7, sites, 50):
+        lines.append( '-{0}'.format(site_name(site)) )
+
+    return '\n'.join(lines) + '\n'
+
+def gen_visitors (hosts, sites, random):
+
+    site_of = random.randint(0, sites, hosts)
+    # Hosts are numbered within their site, so that all addresses are distinct
+    number = pd.Series(site_of).groupby(site_of).cumcount().values
+    # Most awstats hosts are kept as addresses; the rest need DNS
+    named = random.rand(hosts) < 0.3
+
+    names = [ 'wn{0:d}.s{1:d}.example.org'.format(n, s) if is_named
+              else synthetic_address('wn', n, s)
+              for n, s, is_named in zip(number, site_of, named) ]
+    hits = random.zipf(1.5, hosts).clip(1, 10**7)
+
+    return pd.DataFrame({'Host': names, 'Hits': hits,
+                         'Bandwidth': hits * random.randint(500, 5000, hosts)})
+
+def write_awstats_file (file_path, visitors):
+
+    last_visit = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    lines = [ '{0} {1:d} {1:d} {2:d} {3}'.format(host, hits, bandwidth, last_visit)
+              for host, hits, bandwidth in zip(visitors['Host'], visitors['Hits'],
+                                               visitors['Bandwidth']) ]
+
+    header = 'AWSTATS DATA FILE 7.0\nBEGIN_MAP 1\nPOS_VISITOR {0:>10}\nEND_MAP\n'
+    offset = len(header.format(0))
+    with open(file_path, 'w') as fobj:
+        fobj.write(header.format(offset))
+        fobj.write('BEGIN_VISITOR {0:d}\n'.format(len(lines)))
+        fobj.write('\n'.join(lines))
+        fobj.write('\nEND_VISITOR\n')
+
+def gen_records (sites, failing_hosts, days, now_timestamp, random):
+
+    failing_sites = random.choice(sites, max(1, sites // 10), replace=False)
+    site_of = failing_sites[ random.randint(0, len(failing_sites), failing_hosts) ]
+    hosts = [ synthetic_address('wn', n, s) for n, s in enumerate(site_of) ]
+
+    frames = []
+    for hour in reversed(range(days * 24)):
+        # Hosts show up in a random two thirds of the periods
+        present = random.rand(failing_hosts) < 0.66
+        hits = random.randint(1000, 100000, present.sum())
+        frames.append(pd.DataFrame({'Timestamp': now_timestamp - 3600 * hour,
+                                    'Group': 'cmsfrontier',
+                                    'Sites': [ site_name(s) for s in site_of[present] ],
+                                    'Host': np.array(hosts, dtype=object)[present],
+                                    'Ip': np.array(hosts, dtype=object)[present],
+                                    'Alias': '',
+                                    'IsSquid': False,
+                                    'Hits': hits,
+                                    'HitsRate': hits / 3600.0,
+                                    'Bandwidth': hits * 1000,
+                                    'BandwidthRate': hits * 1000 / 3600.0}))
+
+    return pd.concat(frames, ignore_index=True).reindex(columns=hm.record_columns)
+
+stages = [ 'get_awstats_hosts_info', 'download_aggregated_awstats_data',
+           'parse_exceptionlist', 'parse_geolist', 'patch_geo_table', 'CMSTagger',
+           'host_snapshot', 'compute_traffic_delta', 'CMSTagger.tag_hosts',
+           'CMSTagger.tag_hosts (memo)', 'excess_failover_check',
+           'write_failover_record', 'SiteTracker.rebuild', 'issue_emails' ]
+
+def run_benchmark (hosts, days, instances, workers, work_dir, seed):
+
+    random = np.random.RandomState(seed)
+    sites = int(np.clip(hosts // 500, 50, 2000))
+    now_timestamp = int(time.time()) // 3600 * 3600
+    results = []
+
+    def timed (stage, function, *args, **kwargs):
+        start = time.time()
+        value = function(*args, **kwargs)
+        seconds = time.time() - start
+        sys.stderr.write("  {0}: {1:.3f} s\n".format(stage, seconds))
+        results.append({'hosts': hosts, 'sites': sites, 'stage': stage,
+                        'seconds': round(seconds, 6), 'rows': rows_of(value)})
+        return value
+
+    # Inputs
+    date = datetime.today()
+    awstats_base = os.path.join(work_dir, 'awstats')
+    machines = [ 'instance{0:d}'.format(i) for i in range(instances) ]
+    visitors = gen_visitors(hosts, sites, random)
+    for machine in machines:
+        os.makedirs(os.path.join(awstats_base, machine))
+        file_path = "{base}/{instance}/awstats{date}.{instance}.txt".format(
+                            base=awstats_base, instance=machine,
+                            date=date.strftime('%m%Y%d'))
+        write_awstats_file(file_path, visitors)
+
+    geolist = gen_geolist(sites)
+    exceptionlist = gen_exceptionlist(sites)
+    geoip = SyntheticGeoIP()
+    resolver = fl.HostResolver(workers=16)
+
+    config = json.load(open(os.path.join(my_path, 'config.json')))
+    config['record_file'] = os.path.join(work_dir, 'failover-record.csv')
+    config['emails'].update({'record_file': os.path.join(work_dir, 'email-record.csv'),
+                             'list_file': os.path.join(work_dir, 'site-contacts.txt'),
+                             'template_file': os.path.join(my_path, 'failover-email.plain.tpl')})
+    with open(config['emails']['list_file'], 'w') as fobj:
+        for site in range(0, sites, 3):
+            fobj.write('{0} admin@s{1:d}.example.org\n'.format(site_name(site), site))
+
+    # Stages
+    timed('get_awstats_hosts_info', fl.get_awstats_hosts_info, file_path)
+    now_stats = timed('download_aggregated_awstats_data', fl.download_aggregated_awstats_data,
+                      machines, awstats_base, date=date, resolver=resolver, workers=workers)
+
+    actions, WN_view, MO_view = timed('parse_exceptionlist', fl.parse_exceptionlist, exceptionlist)
+    geo_0 = timed('parse_geolist', fl.parse_geolist, geolist, resolver)
+    geo = timed('patch_geo_table', fl.patch_geo_table, geo_0, MO_view, WN_view, actions,
+                geoip, resolver)
+    memo = fl.TagMemo(os.path.join(work_dir, 'tag-memo.pickle'), 'benchmark')
+    tagger = timed('CMSTagger', fl.CMSTagger, geo, geoip, memo=memo)
+
+    # The previous snapshot, an hour ago, misses some hosts and has less traffic
+    last_stats = now_stats[ random.rand(len(now_stats)) < 0.9 ].copy()
+    last_stats['Hits'] = (last_stats['Hits'] * 0.5).astype(int)
+    last_stats['Bandwidth'] = (last_stats['Bandwidth'] * 0.5).astype(int)
+    last_snapshot = timed('host_snapshot', fl.host_snapshot, last_stats)
+    delta = timed('compute_traffic_delta', hm.compute_traffic_delta, now_stats, last_snapshot,
+                  now_timestamp, now_timestamp - 3600)
+
+    tagged = timed('CMSTagger.tag_hosts', tagger.tag_hosts, delta, 'Ip')
+    # The next run finds the same hosts in the memo
+    timed('CMSTagger.tag_hosts (memo)', tagger.tag_hosts, delta, 'Ip')
+    timed('excess_failover_check', hm.excess_failover_check, tagged, 0.1)
+
+    records = gen_records(sites, max(10, hosts // 100), days, now_timestamp, random)
+    timed('write_failover_record', hm.write_failover_record, records,
+          config['record_file'], None, now_timestamp, config.get('rollups'),
+          config['history']['period'])
+
+    tracker = fl.SiteTracker(os.path.join(work_dir, 'site-state.csv'),
+                             60 * config['history']['period'])
+    timed('SiteTracker.rebuild', tracker.rebuild, records)
+    mail_queue = fl.MailQueue(os.path.join(work_dir, 'outbox'), rate=0, backoff=0)
+
+    def issue_emails ():
+        mail_queue.start()
+        hm.issue_emails(records, config, now_timestamp, mail_queue, tracker)
+        return mail_queue.close()
+
+    sent_before = DiscardingSMTP.sent
+    timed('issue_emails', issue_emails)
+    results[-1]['rows'] = DiscardingSMTP.sent - sent_before
+
+    return results
+
+def rows_of (value):
+
+    if isinstance(value, (pd.DataFrame, pd.Series, list)):
+        return len(value)
+    if isinstance(value, tuple):
+        return sum( rows_of(v) for v in value )
+
+    return None
+
+def git_revision ():
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=my_path,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    sys.exit(main())
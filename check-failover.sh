@@ -16,9 +16,16 @@ main()
     io_echo "========================================================="
 
     cd ${here}
-    record_files=$( grep -o '[^"]*\.csv' ${config_file} )
+    # The failover record is only an export when the record store is in use
+    record_files=$( ${CUSTOM_PYTHON_VIRTUALENV}/bin/python -c '
+import json, sys
+config = json.load(open(sys.argv[1]))
+files = [config["emails"]["record_file"]]
+if "record_store" not in config:
+    files.append(config["record_file"])
+print " ".join(files)' ${config_file} )
     for file in ${record_files}; do
-        cp -v $file $file.0 >&2
+        [ -f $file ] && cp -v $file $file.0 >&2
     done
 
     io_echo "Failover Monitor starting at $(date)"
@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 
+import argparse
 import calendar
 import collections
 import getpass
 import json
+import multiprocessing
 import numbers
 import os
-import smtplib
+import signal
 import socket
 import sys
+import threading
 import time
+import traceback
 import types
 import urllib
 
@@ -30,49 +34,475 @@ def main():
     my_path = os.path.dirname(os.path.abspath(__file__))
     os.chdir(my_path)
 
-    config_file = os.path.expanduser(sys.argv[1])
+    args = parse_arguments()
+
+    config_file = os.path.expanduser(args.config_file)
     config = json.load( open(config_file))
     json.dump(config, open(config_file, 'w'), indent=3)
 
-    geoip_database_file = os.path.expanduser(config['geoip_db'])
-    geoip = fl.GeoIPWrapper(geoip_database_file)
+    if args.serve and not args.daemon:
+        # Only answering queries, on whatever the scheduled runs write
+        server = start_query_server(config, open_record_store(config))
+        return wait_for_termination(server)
+
+    state = MonitorState(config)
+
+    if args.replay:
+        output_file = args.output or variant_file_path(config['record_file'], 'replay')
+        try:
+            return run_replay(config, state, args.replay, args.start, args.end, output_file)
+        finally:
+            state.close()
+
+    if args.daemon:
+        if args.serve:
+            start_query_server(config, state.store, lambda: state.last_run_timestamp)
+        try:
+            return run_daemon(config, state)
+        finally:
+            state.close()
+
+    try:
+        run_checks(config, state)
+    finally:
+        state.close()
+
+    return 0
+
+def parse_arguments ():
+
+    parser = argparse.ArgumentParser(description="Detects Frontier clients failing over "
+                                                 "from their site squids.")
+    parser.add_argument('config_file')
+    parser.add_argument('--daemon', action='store_true',
+                        help="Keep running, checking all the groups once per history period")
+    parser.add_argument('--serve', action='store_true',
+                        help="Answer queries on the failover and email records over HTTP")
+    parser.add_argument('--replay', metavar='ARCHIVE',
+                        help="Analyze the awstats snapshots archived in ARCHIVE, in one "
+                             "sub-directory per snapshot named as YYYYmmddHHMM (UTC)")
+    parser.add_argument('--start', type=parse_replay_time,
+                        help="Earliest snapshot to replay, as YYYY-mm-dd[ HH:MM] (UTC)")
+    parser.add_argument('--end', type=parse_replay_time,
+                        help="Latest snapshot to replay, as YYYY-mm-dd[ HH:MM] (UTC)")
+    parser.add_argument('--output',
+                        help="Failover record written by a replay "
+                             "(default: the record file with a 'replay' suffix)")
+
+    return parser.parse_args()
+
+def parse_replay_time (text):
+
+    for time_format in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime_to_UTC_epoch( datetime.strptime(text, time_format) )
+        except ValueError:
+            continue
+
+    raise argparse.ArgumentTypeError("invalid time: {0}".format(text))
+
+def configured_groups (config):
+
+    # Groups are processed in their configured order, the one of the dashboard
+    groups = config['groups']
+    return sorted(groups.keys(), key=lambda name: (groups[name].get('order', 0), name))
+
+class MonitorState(object):
+
+    # What a run needs besides the awstats data, kept warm across daemon cycles
+
+    def __init__ (self, config):
+
+        self.config = config
+
+        # The awstats worker processes are forked first: forking while other
+        # threads run could leave a child stuck on a lock one of them held
+        workers = max([ groupconf.get('awstats_workers', 0)
+                        for groupconf in config['groups'].values() ] +
+                      [ config.get('replay', {}).get('workers', 0) ])
+        self.pool = multiprocessing.Pool(workers) if workers > 1 else None
+
+        self.geoip_database_file = os.path.expanduser(config['geoip_db'])
+        # Loaded while the reference lists are being fetched
+        self.geoip = fl.Stage(fl.GeoIPWrapper, self.geoip_database_file)
+        self.resolver = fl.HostResolver(**config.get('dns', {}))
+        self.fetcher = fl.CachedFetcher(**config.get('cache', {}))
+        self.store = open_record_store(config)
+        self.tracker = fl.SiteTracker(config['emails'].get('state_file', 'site-state.csv'),
+                                      60 * config['history']['period'])
+        # One delivery thread for all the runs, so that none overlap
+        self.mail_queue = fl.MailQueue(**config['emails'].get('outbox', {}))
 
-    exception_list = fl.get_url(config['exception_list'])
-    actions, WN_view, MO_view = fl.parse_exceptionlist(exception_list)
+        self.streams = {}
+        self.last_run_timestamp = None
+        self.reference_timestamp = None
+        self.reference_metrics = None
+        # Resolver and fetcher counts up to the last reported run
+        self.reported_stats = {'dns': collections.Counter(), 'fetch': collections.Counter()}
 
-    geo_list = fl.get_url(config['geo_list'])
-    geo_0 = fl.parse_geolist(geo_list)
+        self.lock = threading.Lock()
+        # Built in the background, as a run only needs it to tag hosts
+        self.initial_reference = fl.Stage(self.refresh_reference_data)
 
-    geo = fl.patch_geo_table(geo_0, MO_view, WN_view, actions, geoip)
-    cms_tagger = fl.CMSTagger(geo, geoip)
+    def refresh_reference_data (self):
+
+        metrics = fl.RunMetrics()
+        geo, cms_tagger = load_reference_data(self.config, self.fetcher, self.geoip,
+                                              self.geoip_database_file, self.resolver,
+                                              metrics)
+        with self.lock:
+            self.geo, self.cms_tagger = geo, cms_tagger
+            self.reference_timestamp = int(time.time())
+            # Reported along with the next run
+            self.reference_metrics = metrics
+
+    def close (self):
+
+        self.mail_queue.close(0)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def take_reference_metrics (self):
+
+        with self.lock:
+            metrics, self.reference_metrics = self.reference_metrics, None
+            return metrics
+
+    def reference_data (self):
+
+        with self.lock:
+            if self.reference_timestamp is not None:
+                return self.geo, self.cms_tagger
+
+        self.initial_reference.result()
+        with self.lock:
+            return self.geo, self.cms_tagger
+
+def run_checks (config, state):
+
+    metrics = fl.RunMetrics()
 
     now_timestamp = datetime_to_UTC_epoch( datetime.utcnow() )
-    current_records = load_records(config['record_file'], now_timestamp, config['history']['span'])
+
+    # Messages left in the outbox by earlier runs start going out right away
+    mail_queue = state.mail_queue
+    mail_queue.start()
+
+    # The groups' traffic is read while the records and the reference data
+    # load, and each group is checked as soon as its own traffic is in. Groups
+    # only share read-only reference data, so they can be analyzed
+    # concurrently; recording and emailing stay in this thread.
+    slots = threading.BoundedSemaphore(max(config.get('group_concurrency', 1), 1))
+
+    records = fl.Stage(load_current_records, config, now_timestamp, state.store, metrics)
+    reference = fl.Stage(state.reference_data)
+    traffics = {}
+    checks = {}
+    for machine_group_name in configured_groups(config):
+        traffic = fl.Stage(load_group_traffic, config, machine_group_name, now_timestamp,
+                           state.resolver, state.streams.get(machine_group_name), metrics,
+                           state.pool, slots=slots)
+        traffics[machine_group_name] = traffic
+        checks[machine_group_name] = fl.Stage(check_group_failovers, config, machine_group_name,
+                                              now_timestamp, traffic, records, reference,
+                                              metrics, slots=slots)
+
+    failovers = dict( (name, check.result()) for name, check in checks.items() )
+    geo, cms_tagger = reference.result()
+
+    reference_metrics = state.take_reference_metrics()
+    if reference_metrics is not None:
+        metrics.extend(reference_metrics)
     failover_groups = []
 
-    for machine_group_name in config['groups'].keys():
+    for machine_group_name in configured_groups(config):
 
-        past_records = get_group_records(current_records, machine_group_name)
-        failover = analyze_failovers_to_group( config, machine_group_name,
-                                               now_timestamp, past_records,
-                                               geo, cms_tagger )
+        failover = failovers[machine_group_name]
         if isinstance(failover, pd.DataFrame):
             failover['Group'] = machine_group_name
-            failover_groups.append(failover.copy())
+            failover_groups.append(failover)
+
+    state.resolver.save()
+    cms_tagger.save_memo()
 
     if len(failover_groups):
-        failover_record = pd.concat(failover_groups, ignore_index=True)
-        write_failover_record(failover_record, config['record_file'])
-        issue_emails(failover_record, config, now_timestamp)
+        failover_record = fl.compact_host_table(pd.concat(failover_groups, ignore_index=True),
+                                                fl.record_category_columns)
+        with metrics.stage('record_write') as stage:
+            write_failover_record(failover_record, config['record_file'], state.store,
+                                  now_timestamp, config.get('rollups'),
+                                  config['history']['period'])
+            stage['rows'] = len(failover_record)
+        with metrics.stage('email'):
+            track_failovers(state.tracker, failover_record, config, now_timestamp)
+            issue_emails(failover_record, config, now_timestamp, mail_queue, state.tracker)
+
+    # The counters move forward only once their interval is recorded, so that
+    # a run failing before that has it analyzed by the next one
+    snapshots = open_snapshot_store(config)
+    with metrics.stage('snapshot_save') as stage:
+        stage['rows'] = 0
+        for machine_group_name, traffic in traffics.items():
+            awdata, counters = traffic.result()
+            if counters is not None:
+                snapshots.save(machine_group_name, counters, now_timestamp)
+                stage['rows'] += len(counters)
+
+    with metrics.stage('email_delivery') as stage:
+        delivered = mail_queue.flush(config['emails'].get('delivery_timeout', 300))
+        record_emails(delivered, config, now_timestamp)
+        stage['rows'] = len(delivered)
+
+    state.tracker.notified(delivered)
+    state.tracker.expire(now_timestamp - 3600 * max(config['history']['span'],
+                                                    config['emails']['periodicity']))
+    state.tracker.save()
+
+    state.last_run_timestamp = now_timestamp
+    report_run_metrics(config, state, metrics)
+
+def report_run_metrics (config, state, metrics):
+
+    stats = {'dns': collections.Counter(state.resolver.stats),
+             'fetch': collections.Counter(state.fetcher.stats)}
+
+    metrics.describe('dns_requests', "Host names looked up in DNS or found in its cache.")
+    metrics.count_changes('dns_requests', state.reported_stats['dns'], stats['dns'])
+    metrics.describe('fetch_requests', "Reference lists downloaded, not modified, or served stale; "
+                                       "parsed results found in the cache or not.")
+    metrics.count_changes('fetch_requests', state.reported_stats['fetch'], stats['fetch'])
+
+    def ratio (counts, hits, misses):
+        total = sum( counts[key] for key in hits + misses )
+        return float(sum( counts[key] for key in hits )) / total if total else 1.0
+
+    dns = stats['dns'] - state.reported_stats['dns']
+    fetch = stats['fetch'] - state.reported_stats['fetch']
+    metrics.describe('cache_hit_ratio', "Share of requests answered from the caches.")
+    metrics.count('cache_hit_ratio', ratio(dns, ['cache_hits'], ['lookups']), cache='dns')
+    metrics.count('cache_hit_ratio', ratio(fetch, ['not_modified'], ['downloaded', 'stale']),
+                  cache='url')
+    metrics.count('cache_hit_ratio', ratio(fetch, ['parsed_hits'], ['parsed_misses']),
+                  cache='parsed')
+    state.reported_stats = stats
+
+    metrics_conf = config.get('metrics', {})
+    if metrics_conf.get('prometheus_file'):
+        metrics.write_prometheus(metrics_conf['prometheus_file'])
+    if metrics_conf.get('summary_file'):
+        metrics.write_json(metrics_conf['summary_file'])
+
+def rows_of (records):
+
+    return len(records) if isinstance(records, pd.DataFrame) else 0
+
+def run_daemon (config, state):
+
+    daemon_conf = config.get('daemon', {})
+    refresh_interval = daemon_conf.get('refresh_interval', 60)          # Unit: minutes
+    heartbeat_interval = daemon_conf.get('heartbeat_interval', 60)      # Unit: seconds
+    status_file = os.path.expanduser(daemon_conf.get('status_file', 'monitor-status.json'))
+
+    # All the groups are checked together once per history period: a failover
+    # is persistent when it is recorded in consecutive periods, and the sites
+    # are tracked across groups. Checking more often takes a shorter period.
+    period = 60 * config['history']['period']
+
+    next_run = 0
+    status = {'pid': os.getpid(), 'started': int(time.time()),
+              'last_run': None, 'last_error': None}
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    refresher = threading.Thread(target=refresh_reference_periodically,
+                                 args=(state, 60 * refresh_interval, stop))
+    refresher.daemon = True
+    refresher.start()
+
+    start_log_streams(config, state, daemon_conf.get('poll_interval', 5), stop)
+
+    while not stop.is_set():
+
+        now = time.time()
+
+        if next_run <= now:
+            try:
+                run_checks(config, state)
+                status['last_error'] = None
+            except Exception:
+                status['last_error'] = traceback.format_exc()
+                sys.stderr.write(status['last_error'])
+            sys.stdout.flush()
+            status['last_run'] = int(now)
+            next_run = now + period
+
+        status['heartbeat'] = int(time.time())
+        status['next_run'] = int(next_run)
+        status['reference_data'] = state.reference_timestamp
+        fl.write_atomically(status_file, json.dumps(status, indent=3))
+
+        wait = next_run - time.time()
+        stop.wait(min(max(wait, 0), heartbeat_interval))
+
+    return 0
+
+def start_query_server (config, store, last_run=None):
+
+    server_conf = config.get('query_server', {})
+    record_file = os.path.expanduser(config['record_file'])
+    emails_file = os.path.expanduser(config['emails']['record_file'])
+
+    read_failovers = csv_record_reader(record_file)
+    read_emails = csv_record_reader(emails_file)
+
+    def failovers (start, end):
+        if store is not None:
+            return store.read(start, end)
+        return read_failovers()
+
+    def emails (start, end):
+        return read_emails()
+
+    def version ():
+        if last_run is not None and last_run() is not None:
+            return last_run()
+        # Served apart from the runs: these files are rewritten by every run
+        mtimes = [ os.path.getmtime(path) for path in (record_file, emails_file)
+                   if os.path.exists(path) ]
+        return int(max(mtimes)) if mtimes else 0
+
+    server = fl.RecordQueryServer((server_conf.get('host', ''), server_conf.get('port', 8080)),
+                                  {'records': failovers, 'emails': emails}, version,
+                                  server_conf.get('cache_entries', 64))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+def csv_record_reader (file_path):
+
+    cached = {'mtime': None, 'records': None}
+    lock = threading.Lock()
+
+    def read ():
+        if not os.path.exists(file_path):
+            return None
+        with lock:
+            mtime = os.path.getmtime(file_path)
+            if mtime != cached['mtime']:
+                cached['records'] = pd.read_csv(file_path, index_col=False)
+                cached['mtime'] = mtime
+            return cached['records']
+
+    return read
+
+def wait_for_termination (server):
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    try:
+        while not stop.wait(60):
+            pass
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
 
     return 0
 
-def load_records (record_file, now_timestamp, record_span):
+def refresh_reference_periodically (state, interval, stop):
+
+    while not stop.wait(interval):
+        try:
+            state.refresh_reference_data()
+        except Exception:
+            sys.stderr.write(traceback.format_exc())
+
+def load_reference_data (config, fetcher, geoip, geoip_database_file, resolver,
+                         metrics=None):
+
+    metrics = metrics or fl.RunMetrics()
+
+    with metrics.stage('fetch'):
+        exception_list = fl.Stage(fetcher.get_url, config['exception_list'])
+        geo_list = fl.Stage(fetcher.get_url, config['geo_list'])
+        exception_list, geo_list = exception_list.result(), geo_list.result()
+
+    with metrics.stage('parse') as stage:
+        geoip = fl.resolve_stage(geoip)
+        # Unchanged lists and GeoIP database give the same geo table and tagger
+        # maps, until the squids' DNS answers in them go stale
+        key = fl.content_digest(exception_list, geo_list,
+                                fl.file_digest(geoip_database_file))
+        parsed = fetcher.load_parsed(key)
+
+        if parsed is None:
+            actions, WN_view, MO_view = fl.parse_exceptionlist(exception_list)
+            geo_0 = fl.parse_geolist(geo_list, resolver)
+
+            geo = fl.patch_geo_table(geo_0, MO_view, WN_view, actions, geoip, resolver)
+            site_maps = None
+        else:
+            geo, site_maps = parsed
+
+        # Tags found for host addresses in earlier runs hold for as long as
+        # the geo table (squid addresses included) and GeoIP database do
+        geo_content = geo.sort_values(list(geo.columns)).to_csv(index=False)
+        memo = fl.TagMemo(os.path.join(fetcher.directory, 'tag-memo.pickle'),
+                          fl.content_digest(key, geo_content))
+        cms_tagger = fl.CMSTagger(geo, geoip, site_maps, memo)
+
+        if parsed is None:
+            previous = fetcher.load_latest_parsed()
+            # Built again (and compared) once any of the squids' DNS answers expire
+            fetcher.save_parsed(key, (geo, cms_tagger.site_maps),
+                                resolver.expiry(geo['Alias'], geo['Ip']))
+            if previous is not None:
+                report_geo_changes(fl.diff_geo_tables(previous[0], geo),
+                                   config.get('geo_changes_file'))
+
+        stage['rows'] = len(geo)
+
+    return geo, cms_tagger
+
+def report_geo_changes (changes, changes_file=None):
+
+    if not len(changes):
+        return
+
+    added = (changes['Change'] == '+').sum()
+    print "Squids in the geo table changed ({0:d} added, {1:d} removed):".format(
+              added, len(changes) - added)
+    print changes.to_string(index=False)
+
+    if changes_file:
+        changes_file = os.path.expanduser(changes_file)
+        changes.insert(0, 'Timestamp', int(time.time()))
+        changes.to_csv(changes_file, mode='a', index=False,
+                       header=not os.path.exists(changes_file))
+
+def open_record_store (config):
+
+    if 'record_store' not in config:
+        return None
+
+    return fl.RecordStore(**config['record_store'])
+
+def load_records (record_file, now_timestamp, record_span, store=None):
 
     old_cutoff = now_timestamp - record_span*3600
     file_path = os.path.expanduser(record_file)
 
-    if os.path.exists(file_path):
+    if store is not None:
+        if store.is_empty() and os.path.exists(file_path):
+            # One-off import of the records kept so far in the flat CSV file
+            store.append(pd.read_csv(file_path, index_col=False))
+        store.expire(old_cutoff)
+        records = store.read(start=old_cutoff)
+
+    elif os.path.exists(file_path):
         records = pd.read_csv(file_path, index_col=False)
         records = records[ records['Timestamp'] >= old_cutoff ]
     else:
@@ -83,40 +513,228 @@ def load_records (record_file, now_timestamp, record_span):
 def get_group_records (records, group_name):
 
     if isinstance(records, pd.DataFrame) and 'Group' in records:
-        return records[ records['Group'] == group_name ].copy()
+        return records[ records['Group'] == group_name ]
     else:
         return None
 
-def analyze_failovers_to_group (config, groupname, now_timestamp, past_records, geo, tagger_object):
+def start_log_streams (config, state, poll_interval, stop):
+
+    for name, groupconf in config['groups'].items():
+        if not groupconf.get('access_logs'):
+            continue
 
+        stream = fl.AccessLogStream(groupconf['access_logs'],
+                                    groupconf.get('log_format', 'squid'),
+                                    groupconf.get('window', 3600),
+                                    groupconf.get('bucket', 60))
+        state.streams[name] = stream
+
+        poller = threading.Thread(target=poll_log_stream,
+                                  args=(stream, poll_interval, stop))
+        poller.daemon = True
+        poller.start()
+
+def poll_log_stream (stream, poll_interval, stop):
+
+    while True:
+        try:
+            stream.poll()
+        except Exception:
+            sys.stderr.write(traceback.format_exc())
+        if stop.wait(poll_interval):
+            break
+
+def load_current_records (config, now_timestamp, store=None, metrics=None):
+
+    metrics = metrics or fl.RunMetrics()
+
+    with metrics.stage('load_records') as stage:
+        current_records = load_records(config['record_file'], now_timestamp,
+                                       config['history']['span'], store)
+        current_records = fl.compact_host_table(current_records, fl.record_category_columns)
+        stage['rows'] = rows_of(current_records)
+
+    return current_records
+
+def load_group_traffic (config, groupname, now_timestamp, resolver, stream=None, metrics=None,
+                        pool=None):
+
+    # The traffic over the last interval, along with the counters it was
+    # computed from (None from a log stream), to be saved once it is recorded
     groupconf = config['groups'][groupname]
+    metrics = metrics or fl.RunMetrics()
+
+    if stream is not None:
+        # Rates come straight from the access logs, over the stream's window
+        with metrics.stage('fetch', groupname) as stage:
+            awdata = stream.rates(resolver, now_timestamp)
+            stage['rows'] = len(awdata)
+        return awdata, None
 
     instances = groupconf['awstats']
     base_path = groupconf['awstats_base']
-    last_stats_file = groupconf['file_last_stats']
-    site_rate_threshold = groupconf['rate_threshold']        # Unit: Queries/sec
+    snapshots = open_snapshot_store(config)
 
-    awdata = fl.download_aggregated_awstats_data(instances, base_path)
-    last_timestamp, last_awdata = load_last_data(last_stats_file)
-    save_last_data(last_stats_file, awdata, now_timestamp)
+    with metrics.stage('fetch', groupname) as stage:
+        # Only the groups setting awstats_workers parse their instances in parallel
+        workers = groupconf.get('awstats_workers', 0)
+        awdata = fl.load_aggregated_awstats_data(instances, base_path, workers=workers,
+                                                 pool=pool if workers > 1 else None)
+        stage['rows'] = len(awdata)
 
-    if last_awdata is None:
+    with metrics.stage('resolve', groupname) as stage:
+        awdata['Ip'] = resolver.get_hosts_ipv4_addr(awdata['Host'])
+        awdata = fl.compact_host_table(awdata)
+        stage['rows'] = len(awdata)
+
+    with metrics.stage('delta', groupname) as stage:
+        last_timestamp, last_snapshot = snapshots.load(groupname)
+        if last_snapshot is None and 'file_last_stats' in groupconf:
+            last_timestamp, last_snapshot = load_last_data(groupconf['file_last_stats'], resolver)
+
+        if last_snapshot is None:
+            return None, awdata
+
+        delta = compute_traffic_delta( awdata, last_snapshot, now_timestamp, last_timestamp)
+        stage['rows'] = len(delta)
+
+    return delta, awdata
+
+def check_group_failovers (config, groupname, now_timestamp, traffic, current_records,
+                           reference, metrics=None):
+
+    awdata, counters = traffic
+    # No traffic to compare with yet, e.g. on the first run
+    if awdata is None:
         return None
 
-    awdata = compute_traffic_delta( awdata, last_awdata, now_timestamp, last_timestamp)
+    geo, tagger_object = reference
+    past_records = get_group_records(current_records, groupname)
 
-    if len(awdata) > 0:
-        tagged_data = tagger_object.tag_hosts(awdata, 'Ip')
-        offending = excess_failover_check(tagged_data, site_rate_threshold)
-    else:
-        offending = None
+    return check_group_traffic(awdata, config['groups'][groupname], past_records,
+                               now_timestamp, tagger_object, metrics, groupname)
+
+def check_group_traffic (awdata, groupconf, past_records, now_timestamp, tagger_object,
+                         metrics=None, groupname=None):
+
+    metrics = metrics or fl.RunMetrics()
+
+    with metrics.stage('tag', groupname) as stage:
+        if len(awdata) > 0:
+            tagged_data = tagger_object.tag_hosts(awdata, 'Ip')
+            offending = excess_failover_check(tagged_data, groupconf['rate_threshold'])
+            stage['rows'] = len(offending)
+        else:
+            offending = None
 
     failovers = update_record(offending, past_records, now_timestamp)
     gen_report(offending, groupconf['name'])
 
     return failovers
 
-def load_last_data (last_stats_file):
+replay_snapshot_format = '%Y%m%d%H%M'
+
+def list_archived_snapshots (archive, start=None, end=None):
+
+    snapshots = []
+    for name in sorted(os.listdir(archive)):
+        try:
+            date = datetime.strptime(name, replay_snapshot_format)
+        except ValueError:
+            continue
+
+        timestamp = datetime_to_UTC_epoch(date)
+        if start is not None and timestamp < start:
+            continue
+        if end is not None and timestamp > end:
+            continue
+        snapshots.append( (timestamp, os.path.join(archive, name), date) )
+
+    return snapshots
+
+def run_replay (config, state, archive, start=None, end=None, output_file=None):
+
+    snapshots = list_archived_snapshots(os.path.expanduser(archive), start, end)
+    if len(snapshots) < 2:
+        sys.stderr.write("At least two snapshots in {0} are needed for a replay.\n".format(archive))
+        return 1
+
+    workers = config.get('replay', {}).get('workers', 0)
+    geo, cms_tagger = state.reference_data()
+    failover_groups = []
+    for groupname in configured_groups(config):
+        groupconf = config['groups'][groupname]
+        failovers = replay_group(groupconf, snapshots, cms_tagger, state.resolver, workers,
+                                 state.pool)
+        if failovers is not None:
+            failovers['Group'] = groupname
+            failover_groups.append(failovers)
+
+    state.resolver.save()
+    cms_tagger.save_memo()
+
+    if not failover_groups:
+        print "No failovers found in {0} snapshots.".format(len(snapshots))
+        return 0
+
+    failover_record = pd.concat(failover_groups, ignore_index=True)\
+                        .sort_values('Timestamp', kind='mergesort')
+    failover_record = fl.compact_host_table(failover_record, fl.record_category_columns)
+    write_failover_record(failover_record, output_file, rollups=config.get('rollups'),
+                          period=config['history']['period'])
+
+    print "{0} failover records over {1} snapshots written to {2}.".format(
+              len(failover_record), len(snapshots), output_file)
+    return 0
+
+def replay_group (groupconf, snapshots, tagger_object, resolver, workers=0, pool=None):
+
+    tables = fl.load_archived_awstats_data(groupconf['awstats'],
+                                           [ (path, date) for _, path, date in snapshots ],
+                                           workers, pool)
+
+    # Every host is resolved once for the whole range
+    hosts = pd.concat([ table['Host'] for table in tables ]).unique()
+    addresses = resolver.get_hosts_ipv4_addr(hosts)
+    addresses.index = hosts
+
+    intervals = []
+    last_timestamp, last_snapshot = None, None
+    for (timestamp, _, _), awdata in zip(snapshots, tables):
+        if not len(awdata):
+            # A missing snapshot is skipped, rather than taken as zero traffic
+            continue
+
+        awdata['Ip'] = awdata['Host'].map(addresses)
+        awdata = fl.compact_host_table(awdata)
+
+        if last_snapshot is not None:
+            delta = compute_traffic_delta(awdata, last_snapshot, timestamp, last_timestamp)
+            delta['Timestamp'] = timestamp
+            intervals.append(delta)
+
+        last_timestamp, last_snapshot = timestamp, fl.host_snapshot(awdata)
+
+    if not intervals:
+        return None
+
+    # All intervals are tagged in one batch, then checked one by one
+    batch = fl.compact_host_table(pd.concat(intervals, ignore_index=True))
+    tagged = tagger_object.tag_hosts(batch, 'Ip')
+    offending = [ excess_failover_check(interval, groupconf['rate_threshold'])
+                  for _, interval in tagged.groupby('Timestamp') ]
+
+    return pd.concat(offending, ignore_index=True)
+
+def open_snapshot_store (config):
+
+    return fl.SnapshotStore(**config.get('snapshots', {}))
+
+def load_last_data (last_stats_file, resolver):
+
+    # One-off import of the counters kept so far in a last_stats CSV file,
+    # which are superseded by the snapshot store
+    last_stats_file = os.path.expanduser(last_stats_file)
 
     if os.path.exists(last_stats_file):
         fobj = open(last_stats_file)
@@ -124,58 +742,46 @@ def load_last_data (last_stats_file):
         fobj.close()
 
         last_awdata = pd.read_csv(last_stats_file, index_col=False, skiprows=1)
-        last_awdata['Ip'] = last_awdata['Host'].apply(fl.get_host_ipv4_addr)
+        last_awdata['Ip'] = resolver.get_hosts_ipv4_addr(last_awdata['Host'])
+        last_snapshot = fl.host_snapshot(last_awdata)
 
     else:
-        last_awdata = None
+        last_snapshot = None
         last_timestamp = None
 
-    return last_timestamp, last_awdata
-
-def save_last_data (last_stats_file, data, timestamp):
-
-    fobj = open(last_stats_file, 'w')
-    fobj.write( '{0:d}\n'.format(timestamp) )
-    data.to_csv(fobj, index=False)
-    fobj.close()
+    return last_timestamp, last_snapshot
 
 def datetime_to_UTC_epoch (dt):
 
     return int(calendar.timegm( dt.utctimetuple()))
 
-def compute_traffic_delta (now_stats_indexless, last_stats_indexless, now_timestamp, last_timestamp):
-
-    cols = ['Hits', 'Bandwidth']
+def compute_traffic_delta (now_stats, last_snapshot, now_timestamp, last_timestamp):
 
-    now_stats = now_stats_indexless.set_index('Ip')
-    last_stats = last_stats_indexless.set_index('Ip')
+    cols = fl.snapshot_counter_columns
 
-    # Get the deltas and rates of Hits and Bandwidth of recently updated/added hosts
-    now_aligned, last_aligned = now_stats[cols].align(last_stats[cols], join='left')
-    # Set previously unrecorded hosts as zero traffic
-    deltas = now_aligned - last_aligned.fillna(0)
+    # Get the deltas and rates of Hits and Bandwidth of recently updated/added
+    # hosts. Previously unrecorded hosts are found with zero traffic.
+    last_counters = fl.snapshot_counters(last_snapshot, now_stats, cols)
+    deltas = pd.DataFrame(dict( (col, now_stats[col].values - last_counters[col])
+                                for col in cols ),
+                          index=now_stats.index, columns=cols)
     # Filter out hosts whose recent activity is null
-    are_active = (deltas['Hits'] > 0) & (deltas['Bandwidth'] > 0)
-    active = deltas[are_active].copy()
-
-    inactive = deltas[~are_active].copy()
-    inactive['WasOld'] = inactive.index
-    inactive['WasOld'] = inactive['WasOld'].isin(last_stats.index)
+    are_active = ((deltas['Hits'] > 0) & (deltas['Bandwidth'] > 0)).values
+    active = deltas[are_active]
 
     # Add computed columns to table, dropping the original columns since they
     # are an accumulation.
     delta_t = float(now_timestamp - last_timestamp)
     rates = active / delta_t
     rates = rates.rename(columns = lambda x: x + "Rate")
-    table = now_stats.drop(cols, axis=1)\
-                     .join([active, rates], how='inner')
-    table.reset_index(inplace=True)
+    table = pd.concat([now_stats[are_active].drop(cols, axis=1), active, rates], axis=1)
 
-    return table
+    columns = ['Ip'] + [ col for col in table.columns if col != 'Ip' ]
+    return table.reindex(columns=columns).reset_index(drop=True)
 
 def excess_failover_check (awdata, site_rate_threshold):
 
-    non_squid_stats = awdata[ ~awdata['IsSquid'] ].copy()
+    non_squid_stats = awdata[ ~awdata['IsSquid'] ]
     by_sites = non_squid_stats.groupby('Sites')
 
     totals = by_sites['HitsRate'].sum()
@@ -183,30 +789,24 @@ def excess_failover_check (awdata, site_rate_threshold):
 
     offending = awdata[ awdata['Sites'].isin(totals_high.index) ]
 
-    return offending.copy()
+    return offending
 
 def gen_report (offending, groupname):
 
-    print "Failover activity to %s:" % groupname,
+    # The report is printed in a single statement, as groups may run concurrently
+    header = "Failover activity to %s:" % groupname
 
-    if offending is None:
-        print " None.\n"
+    if offending is None or len(offending) == 0:
+        print header + "  None.\n"
         return
 
-    for_report = offending.copy()
-
-    if len(for_report) > 0:
-
-        pd.options.display.precision = 2
-        pd.options.display.width = 130
-        pd.options.display.max_rows = 100
+    pd.options.display.precision = 2
+    pd.options.display.width = 130
+    pd.options.display.max_rows = 100
 
-        to_print = for_report.set_index(['Sites', 'IsSquid', 'Host']).sortlevel(0)
-        column_order = ['Hits', 'HitsRate', 'Bandwidth', 'BandwidthRate']
-        print "\n" + to_print.reindex(columns=column_order).to_string() + "\n"
-
-    else:
-        print " None.\n"
+    to_print = offending.set_index(['Sites', 'IsSquid', 'Host']).sortlevel(0)
+    column_order = ['Hits', 'HitsRate', 'Bandwidth', 'BandwidthRate']
+    print header + " \n" + to_print.reindex(columns=column_order).to_string() + "\n"
 
 def update_record (offending, past_records, now_timestamp):
 
@@ -224,53 +824,132 @@ def update_record (offending, past_records, now_timestamp):
 
     return updated
 
-def write_failover_record (record, file_path):
+record_columns = ["Timestamp", "Group", "Sites", "Host", "Ip", "Alias", "IsSquid",
+                  "Bandwidth", "BandwidthRate", "Hits", "HitsRate"]
+
+top_hosts_columns = ["Sites", "Host", "Ip", "Alias", "IsSquid",
+                     "Hits", "Bandwidth", "Records", "LastSeen"]
+
+def variant_file_path (file_path, variant):
+
+    file_parts = file_path.split('.')
+    file_parts.insert(len(file_parts)-1, variant)
+
+    return '.'.join(file_parts)
 
-    column_order = ["Timestamp", "Group", "Sites", "Host", "Ip", "Alias", "IsSquid",
-                    "Bandwidth", "BandwidthRate", "Hits", "HitsRate"]
+def write_failover_record (record, file_path, store=None, now_timestamp=None,
+                           rollups=None, period=60):
 
-    failover_record = record.reindex(columns=column_order)
+    failover_record = record.reindex(columns=record_columns)
     failover_record['Bandwidth'] = failover_record['Bandwidth'].astype(int)
     failover_record['Hits'] = failover_record['Hits'].astype(int)
     failover_record['Timestamp'] = failover_record['Timestamp'].astype(int)
 
-    reduced_file_parts = file_path.split('.')
-    reduced_file_parts.insert(len(reduced_file_parts)-1, 'reduced')
-    reduced_file_path = '.'.join(reduced_file_parts)
+    reduced_file_path = variant_file_path(file_path, 'reduced')
+    # Outputs have plain strings instead of the compact schema
+    output_record = fl.expand_host_table(failover_record)
 
     grouping = ['Group', 'Sites', 'IsSquid']
     field_ops = dict( (field, pd.np.sum) for field in
                        ('Hits', 'HitsRate', 'Bandwidth', 'BandwidthRate') )
 
-    reduced_stats = failover_record.groupby(grouping, group_keys=False)\
-                                   .apply(reduce_to_rank, columns='HitsRate',
-                                          ranks=12, reduction_ops=field_ops,
-                                          tagged_fields=['Host', 'Alias'])
+    reduced_stats = reduce_to_rank(output_record, grouping, 'HitsRate', ranks=12,
+                                   reduction_ops=field_ops, tagged_fields=['Host', 'Alias'])
 
-    failover_record.to_csv(file_path, index=False, float_format="%.2f")
+    if store is not None:
+        # Only this run's rows are stored; the CSV is exported for the dashboard
+        store.append(failover_record[ failover_record['Timestamp'] == now_timestamp ])
+        store.export_csv(file_path, record_columns, start=failover_record['Timestamp'].min())
+    else:
+        output_record.to_csv(file_path, index=False, float_format="%.2f")
     reduced_stats.to_csv(reduced_file_path, index=False, float_format="%.2f")
 
-def reduce_to_rank (dataframe, columns, ranks=5, reduction_ops={}, tagged_fields=[]):
+    if rollups is not None:
+        write_record_rollups(output_record, file_path, rollups, period)
+
+def write_record_rollups (failover_record, file_path, rollups, period):
+
+    # The compact files the dashboard loads before any raw record: totals per
+    # time bucket, site, group and squid flag, and the top hosts of every site
+    # over the whole record span
+    bucket_span = 60 * rollups.get('bucket', period)        # Unit: seconds
+    compress = rollups.get('gzip', True)
+
+    rollup = fl.rollup_records(failover_record, bucket_span)
+
+    by_host = failover_record.groupby(['Sites', 'Host'])\
+                             .agg({'Ip': 'last', 'Alias': 'last', 'IsSquid': pd.np.max,
+                                   'Hits': pd.np.sum, 'Bandwidth': pd.np.sum,
+                                   'Group': 'count', 'Timestamp': pd.np.max})
+    by_host = by_host.rename(columns={'Group': 'Records', 'Timestamp': 'LastSeen'})\
+                     .reset_index()
+    top_hosts = by_host.sort_values(['Sites', 'Hits'], ascending=[True, False])\
+                       .groupby('Sites').head(rollups.get('top_hosts', 10))\
+                       .reindex(columns=top_hosts_columns)
+
+    outputs = [ (rollup, variant_file_path(file_path, 'rollup')),
+                (top_hosts, variant_file_path(file_path, 'tophosts')) ]
+    for table, path in outputs:
+        table.to_csv(path, index=False, float_format="%.2f")
+
+    if compress:
+        # Pre-compressed copies, for servers that can hand them out as they are
+        for path in [file_path] + [ path for _, path in outputs ]:
+            with open(path, 'rb') as source:
+                fl.write_atomically(path + '.gz', fl.gzip_bytes(source.read()))
+
+def reduce_to_rank (dataframe, grouping, columns, ranks=5, reduction_ops={}, tagged_fields=[]):
+
+    # Groups with more than `ranks` rows keep their top ones, by `columns`,
+    # and an 'Others' row reducing the rest. All groups are ranked at once.
+    df = dataframe.dropna(subset=grouping)\
+                  .sort_values(grouping + [columns], kind='mergesort',
+                               ascending=[True] * len(grouping) + [False])
+    if not len(df):
+        return df
+
+    keys = df[grouping]
+    starts = (keys != keys.shift()).any(axis=1).values
+    group_ids = starts.cumsum() - 1
+    positions = pd.np.arange(len(df))
+    ranking = positions - pd.np.maximum.accumulate(pd.np.where(starts, positions, 0))
+    sizes = pd.np.bincount(group_ids)[group_ids]
+
+    in_rank = (ranking < ranks) | (sizes <= ranks)
+    if in_rank.all():
+        return df
+
+    all_reduction_ops = dict( (field, 'max') for field in df.columns )
+    all_reduction_ops.update( (field, 'first') for field in grouping )
+    all_reduction_ops.update(reduction_ops)
 
-    if len(dataframe) <= ranks:
-        return dataframe
+    out_of_rank = df[~in_rank]
+    others = out_of_rank.groupby(group_ids[~in_rank]).agg(all_reduction_ops)
+    for field in tagged_fields:
+        others[field] = 'Others'
 
-    df = dataframe.sort_index(by=columns, ascending=False)
+    # Each 'Others' row goes right after the top rows of its group
+    order = pd.np.concatenate([ group_ids[in_rank] * (ranks + 1) + ranking[in_rank],
+                                others.index.values * (ranks + 1) + ranks ])
+    reduced = pd.concat([df[in_rank], others.reindex(columns=df.columns)], ignore_index=True)
 
-    all_reduction_ops = dict( (field, pd.np.max) for field in df.columns )
-    all_reduction_ops.update(reduction_ops)
+    return reduced.iloc[ pd.np.argsort(order, kind='mergesort') ]
 
-    reduced = df[:ranks].T.copy()
-    out_of_rank = df[ranks:]
-    to_add = pd.Series( dict( (field, func(out_of_rank[field])) for field, func in
-                         all_reduction_ops.items() ))
-    if len(tagged_fields):
-        to_add[tagged_fields] = 'Others'
-    reduced['Others'] = to_add
+def track_failovers (tracker, records, config, now_timestamp):
 
-    return reduced.T.copy()
+    if tracker.restored:
+        tracker.update(records.Sites[ records.Timestamp == now_timestamp ], now_timestamp)
+        return
 
-def mark_activity_for_mail (records, now_timestamp, window=None):
+    # Without a saved state, it is first built from the records kept so far
+    emails_records = load_records(config['emails']['record_file'], now_timestamp,
+                                  config['history']['span'])
+    notifications = []
+    if isinstance(emails_records, pd.DataFrame):
+        notifications = emails_records[['Sites', 'Timestamp']].to_dict('records')
+    tracker.rebuild(records, notifications)
+
+def mark_activity_for_mail (records, now_timestamp, window=None, period=3600):
 
     if isinstance(window, numbers.Number):
         start_of_window = now_timestamp - window*3600
@@ -279,22 +958,32 @@ def mark_activity_for_mail (records, now_timestamp, window=None):
         view = records
 
     x = view[['Sites', 'Timestamp']].drop_duplicates()
-    # Wait is the time (in hours) elapsed between failover event records
-    x['Wait'] = x.groupby('Sites')['Timestamp'].diff().fillna(0)/3600.0
-    x.Wait = x.Wait.round().astype(int) - 1
+    # Wait is the amount of runs elapsed between failover event records
+    x['Wait'] = fl.wait_periods( x.groupby('Sites')['Timestamp'].diff().fillna(0), period )
 
     # persistent failover is that which has no wait (i.e. happens continuously)
     persistent = x[x.Wait == 0]
     to_report = persistent.Sites.unique()
 
-    sys.stderr.write("Wait times in hours:\n" + x.to_string() + "\n")
-
     return to_report
 
-def issue_emails (records, config, now_timestamp):
+def issue_emails (records, config, now_timestamp, mail_queue, tracker=None):
+
+    periodicity = config['emails']['periodicity']
+    period = 60 * config['history']['period']
 
-    marked = mark_activity_for_mail(records, now_timestamp,
-                                    window=config['emails']['periodicity'])
+    if tracker is None:
+        marked = mark_activity_for_mail(records, now_timestamp, periodicity, period)
+    else:
+        # The tracker can outlive the records of a site (a longer email
+        # periodicity than the record span, a group whose check failed), and
+        # an email is only composed from its records
+        recorded = set(records.Sites.unique())
+        marked = [ sites for sites in tracker.persistent_sites(now_timestamp, periodicity)
+                   if sites in recorded ]
+        if config['emails'].get('verify_state'):
+            verify_tracked_sites(marked, mark_activity_for_mail(records, now_timestamp,
+                                                                periodicity, period))
     if not len(marked):
         return
 
@@ -307,47 +996,42 @@ def issue_emails (records, config, now_timestamp):
     mailing_list = config['emails']['support_list']
     operator_email = config['emails']['operator_email']
     alarm_list = config['emails']['alarm_list']
-    emails_records = load_records(config['emails']['record_file'], now_timestamp,
-                                  config['history']['span'])
 
     format_floats = lambda f: unicode("{0:.2f}".format(f))
     rate_col_name = "RateThreshold [*]"
     groupcode_name = "GCode"
     groups = []
-    for group_key, group_info in config['groups'].items():
+    for group_key in configured_groups(config):
+        group_info = config['groups'][group_key]
         groups.append({"Group": group_info['name'],
                        rate_col_name: group_info['rate_threshold'],
                        groupcode_name: group_key})
     column_order = ['Group', groupcode_name, rate_col_name]
     groups_df = pd.DataFrame.from_records(groups, columns=column_order)
 
-    sent_emails = []
-    if isinstance(emails_records, pd.DataFrame):
-        start_of_window = now_timestamp - config['emails']['periodicity']*3600
-        recent_notifications = emails_records[ emails_records.Timestamp >= start_of_window ]
-        new_sites = set(marked) - set(recent_notifications.Sites.tolist())
+    # Sites whose email is in the outbox, or was just sent from it, count as notified
+    notified = set( meta['Sites'] for meta in mail_queue.notifications() )
+    if tracker is not None:
+        notified.update(tracker.notified_sites(now_timestamp, periodicity))
     else:
-        new_sites = marked
+        emails_records = load_records(config['emails']['record_file'], now_timestamp,
+                                      config['history']['span'])
+        if isinstance(emails_records, pd.DataFrame):
+            start_of_window = now_timestamp - periodicity*3600
+            recent_notifications = emails_records[ emails_records.Timestamp >= start_of_window ]
+            notified.update(recent_notifications.Sites.tolist())
+    new_sites = set(marked) - notified
 
     print "Sites to send alarm to:\n", new_sites
 
+    tables, aggregations = email_tables(records, new_sites, groupcode_name)
+    server_groups = groups_df.to_string(index=False, float_format=format_floats,
+                                        justify='right')
+
+    messages = []
     for sites in new_sites:
 
         site_list = sites.split(sites_delimiter)
-        from_site = records[records.Sites == sites]
-        latest_timestamp = from_site.Timestamp.max()
-        view = from_site[from_site.Timestamp == latest_timestamp]\
-                        .drop(['Sites', 'Timestamp'], axis=1)\
-                        .rename(columns={'Group': groupcode_name})
-        table = view.set_index(['IsSquid', groupcode_name, 'Host'])\
-                    .sortlevel(0, ascending=False)\
-                    .reindex(columns=['Ip', 'Hits', 'Bandwidth'])
-        table.Bandwidth = table.Bandwidth.apply(fl.from_bytes)
-
-        aggregation = view.groupby(['IsSquid', groupcode_name])['Hits', 'Bandwidth'].sum()\
-                          .sortlevel(0, ascending=False)
-        aggregation.Bandwidth = aggregation.Bandwidth.apply(fl.from_bytes)
-
         if any( site in contacts for site in site_list ):
             target_emails = fl.flatten( contacts[site] for site in site_list )
         else:
@@ -359,25 +1043,66 @@ def issue_emails (records, config, now_timestamp):
                                       support_email=mailing_list,
                                       base_url=config['base_url'],
                                       site_name=sites,
-                                      server_groups=groups_df.to_string(index=False,
-                                                                        float_format=format_floats,
-                                                                        justify='right'),
-                                      summary_table=table.to_string(justify='right'),
-                                      aggregated_table=aggregation.to_string(justify='right'),
+                                      server_groups=server_groups,
+                                      summary_table=tables[sites].to_string(justify='right'),
+                                      aggregated_table=aggregations[sites].to_string(justify='right'),
                                       period=config['history']['period'])
+        messages.append( (sites, target_emails, message_str) )
+
+    for sites, target_emails, message_str in messages:
 
         print "\nAbout to send email about", sites, "to:", email.utils.COMMASPACE.join(target_emails)
 
-        successful = send_email("Direct Connections to Frontier servers from " + sites,
-                                message_str,
-                                to=target_emails,
-                                cc=alarm_list,
-                                reply_to=mailing_list)
+        sender, recipients, msg = compose_email("Direct Connections to Frontier servers from " + sites,
+                                                message_str,
+                                                to=target_emails,
+                                                cc=alarm_list,
+                                                reply_to=mailing_list)
+        mail_queue.enqueue(sender, recipients, msg.as_string(),
+                           meta={'Timestamp': now_timestamp, 'Sites': sites,
+                                 'Addresses': ', '.join(target_emails)})
+
+    return
+
+def verify_tracked_sites (tracked, from_records):
+
+    missing = set(from_records) - set(tracked)
+    unexpected = set(tracked) - set(from_records)
+    if missing or unexpected:
+        sys.stderr.write("Site state differs from the records: missing {0}, unexpected {1}.\n"
+                         .format(sorted(missing), sorted(unexpected)))
+
+def email_tables (records, sites, groupcode_name):
+
+    # The hosts and per group totals in the latest record of each of the sites,
+    # all taken from a single pass over the records
+    flagged = records[ records.Sites.isin(sites) ]
+    latest = flagged.Timestamp.groupby(pd.np.asarray(flagged.Sites)).transform('max')
+    view = fl.expand_host_table(flagged[ (flagged.Timestamp == latest).values ])\
+             .rename(columns={'Group': groupcode_name})
+
+    order = ['Sites', 'IsSquid', groupcode_name, 'Host']
+    hosts = view.sort_values(order, ascending=[True, False, False, False])
+    hosts['Bandwidth'] = hosts.Bandwidth.apply(fl.from_bytes)
+
+    totals = view.groupby(order[:-1])[['Hits', 'Bandwidth']].sum().reset_index()\
+                 .sort_values(order[:-1], ascending=[True, False, False])
+    totals['Bandwidth'] = totals.Bandwidth.apply(fl.from_bytes)
 
-        if successful:
-            sent_emails.append({'Timestamp': now_timestamp, 'Sites': sites,
-                                'Addresses': ', '.join(target_emails)})
-            time.sleep(1)
+    tables = dict( (site, rows.set_index(order[1:]).reindex(columns=['Ip', 'Hits', 'Bandwidth']))
+                   for site, rows in hosts.groupby('Sites', sort=False) )
+    aggregations = dict( (site, rows.set_index(order[1:-1])[['Hits', 'Bandwidth']])
+                         for site, rows in totals.groupby('Sites', sort=False) )
+
+    return tables, aggregations
+
+def record_emails (sent_emails, config, now_timestamp):
+
+    if not sent_emails:
+        return
+
+    emails_records = load_records(config['emails']['record_file'], now_timestamp,
+                                  config['history']['span'])
 
     new_df = pd.DataFrame.from_records(sent_emails)
     if isinstance(emails_records, pd.DataFrame):
@@ -386,9 +1111,7 @@ def issue_emails (records, config, now_timestamp):
 
     new_df.to_csv(os.path.expanduser(config['emails']['record_file']), index=False)
 
-    return
-
-def send_email (subject, message, to, reply_to='', cc='', html_message=''):
+def compose_email (subject, message, to, reply_to='', cc='', html_message=''):
 
     #user, host = get_user_and_host_names()
     user, host = "squidmon", "mail.cern.ch"
@@ -414,16 +1137,7 @@ def send_email (subject, message, to, reply_to='', cc='', html_message=''):
     if html_message:
         msg.attach( MIMEText(html_message, 'html'))
 
-    try:
-        smtpObj = smtplib.SMTP('localhost')
-        smtpObj.set_debuglevel(True)
-        smtpObj.sendmail(sender, receivers + copies, msg.as_string())
-        smtpObj.quit()
-        print "\nSuccessfully sent email to:", msg['To']
-        print " CC'ed to:", msg['CC']
-        return True
-    except:
-        return False
+    return sender, receivers + copies, msg
 
 def get_user_and_host_names():
 
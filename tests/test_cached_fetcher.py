@@ -0,0 +1,166 @@
+#! /usr/bin/env python
+
+# CachedFetcher against a local HTTP server standing in for the list server:
+# conditional requests (ETag / If-Modified-Since), falling back to the last
+# good copy, and expiry of the parsed results.
+
+import BaseHTTPServer
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import FailoverLib as fl
+
+class ListServer(BaseHTTPServer.HTTPServer):
+
+    def __init__ (self):
+
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), ListHandler)
+
+        self.body = 'T2_XX_Site0 -wn0.s0.org\n'
+        self.etag = '"v1"'
+        self.last_modified = 'Mon, 01 Jan 2024 00:00:00 GMT'
+        self.error = None
+        self.requests = []
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url (self):
+
+        return 'http://127.0.0.1:{0:d}/exceptionlist.txt'.format(self.server_address[1])
+
+    def stop (self):
+
+        self.shutdown()
+        self.server_close()
+
+class ListHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET (self):
+
+        server = self.server
+        server.requests.append(dict(self.headers))
+
+        if server.error is not None:
+            self.send_error(server.error)
+            return
+
+        if ( self.headers.getheader('If-None-Match') == server.etag or
+             self.headers.getheader('If-Modified-Since') == server.last_modified ):
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('ETag', server.etag)
+        self.send_header('Last-Modified', server.last_modified)
+        self.send_header('Content-Length', str(len(server.body)))
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message (self, format, *args):
+        pass
+
+class CachedFetcherTest(unittest.TestCase):
+
+    def setUp (self):
+
+        self.directory = tempfile.mkdtemp()
+        self.server = ListServer()
+        self.fetcher = fl.CachedFetcher(self.directory, timeout=5)
+        # Stale copies are warned about on stderr
+        self.stderr, sys.stderr = sys.stderr, open(os.devnull, 'w')
+
+    def tearDown (self):
+
+        sys.stderr = self.stderr
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_download (self):
+
+        self.assertEqual(self.fetcher.get_url(self.server.url), self.server.body)
+        self.assertEqual(self.fetcher.stats['downloaded'], 1)
+        self.assertNotIn('if-none-match', self.server.requests[0])
+
+    def test_not_modified (self):
+
+        body = self.fetcher.get_url(self.server.url)
+
+        self.assertEqual(self.fetcher.get_url(self.server.url), body)
+        self.assertEqual(self.fetcher.stats['not_modified'], 1)
+        self.assertEqual(self.server.requests[-1].get('if-none-match'), self.server.etag)
+        self.assertEqual(self.server.requests[-1].get('if-modified-since'),
+                         self.server.last_modified)
+
+    def test_modified_since (self):
+
+        self.fetcher.get_url(self.server.url)
+        # Only the date can tell the copy is current
+        self.server.etag = '"v2"'
+
+        self.assertEqual(self.fetcher.get_url(self.server.url), self.server.body)
+        self.assertEqual(self.fetcher.stats['not_modified'], 1)
+
+    def test_changed (self):
+
+        self.fetcher.get_url(self.server.url)
+        self.server.body = 'T2_XX_Site1 -wn0.s1.org\n'
+        self.server.etag = '"v2"'
+        self.server.last_modified = 'Tue, 02 Jan 2024 00:00:00 GMT'
+
+        self.assertEqual(self.fetcher.get_url(self.server.url), self.server.body)
+        self.assertEqual(self.fetcher.stats['downloaded'], 2)
+        # The new validators are the ones sent next
+        self.fetcher.get_url(self.server.url)
+        self.assertEqual(self.server.requests[-1].get('if-none-match'), '"v2"')
+
+    def test_stale_on_server_error (self):
+
+        body = self.fetcher.get_url(self.server.url)
+        self.server.error = 503
+
+        self.assertEqual(self.fetcher.get_url(self.server.url), body)
+        self.assertEqual(self.fetcher.stats['stale'], 1)
+
+    def test_stale_on_server_down (self):
+
+        body = self.fetcher.get_url(self.server.url)
+        url = self.server.url
+        self.server.stop()
+
+        self.assertEqual(self.fetcher.get_url(url), body)
+        self.assertEqual(self.fetcher.stats['stale'], 1)
+
+    def test_no_copy_to_fall_back_to (self):
+
+        self.server.error = 503
+        self.assertRaises(urllib2.HTTPError, self.fetcher.get_url, self.server.url)
+
+        url = self.server.url
+        self.server.stop()
+        self.assertRaises(urllib2.URLError, self.fetcher.get_url, url)
+
+    def test_parsed_expiry (self):
+
+        self.fetcher.save_parsed('a', 'parsed a')
+        self.assertEqual(self.fetcher.load_parsed('a'), 'parsed a')
+
+        self.fetcher.save_parsed('b', 'parsed b', expires=time.time() - 1)
+        self.assertIsNone(self.fetcher.load_parsed('b'))
+        self.assertEqual(self.fetcher.stats['parsed_expired'], 1)
+        # Still there to compare the next results with
+        self.assertEqual(self.fetcher.load_latest_parsed(), 'parsed b')
+
+if __name__ == '__main__':
+    unittest.main()
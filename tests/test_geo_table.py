@@ -0,0 +1,176 @@
+#! /usr/bin/env python
+
+# The batched geo list expansion and the anti-join in patch_geo_table give
+# the same table as the per-proxy expansion and per-exception masking they
+# replaced (kept below as the reference), over a fake DNS.
+
+import os
+import socket
+import sys
+import unittest
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import FailoverLib as fl
+
+dns = {'sq0.s1.org': ['10.1.0.0'], 'sq1.s1.org': ['10.1.0.1'], 'sq2.s1.org': ['10.1.0.2'],
+       'sq0.s2.org': ['10.2.0.0'], 'sq1.s2.org': ['10.2.0.1'],
+       'sq0.s3.org': ['10.3.0.0'], 'sq1.s3.org': ['10.3.0.1'],
+       # A round-robin alias
+       'squid.s4.org': ['10.4.0.1', '10.4.0.2'], 'sq0.s4.org': ['10.4.0.0'],
+       'sq0.s5.org': ['10.5.0.0'],
+       'mon.s2.org': ['10.2.0.9'], 'mon.s6.org': ['10.6.0.9']}
+
+geo_list = '\n'.join([
+    'Directory /Inst1> S T2_XX_S1 P http:sq0.s1.org:3128|http:sq1.s1.org:3128;DIRECT E',
+    'Directory /Inst2> S T2_XX_S2 P http:sq0.s2.org:3128|http:sq1.s2.org:3128;DIRECT E',
+    'Directory /Inst3> S T1_XX_S3 P http:sq0.s3.org:3128|http:sq1.s3.org:3128;DIRECT E',
+    'Directory /Inst4> S T3_XX_S4 P http:squid.s4.org:3128|http:sq0.s4.org:3128;DIRECT E',
+    'Directory /Inst5> S T2_XX_S5 P http:sq0.s5.org:3128;DIRECT E',
+    'Directory /Inst6> S T2_XX_S6 P http:gone.s6.org:3128|http:10.6.0.1:3128;DIRECT E'])
+
+exception_list = '\n'.join([
+    '# Worker nodes by host name and by alias, monitoring hosts old and new',
+    'T2_XX_S1 -host-10-1-0-0.s1.org +sq2.s1.org',
+    'T2_XX_S2 -sq1.s2.org +mon.s2.org +sq0.s2.org',
+    'T2_XX_S6 +mon.s6.org',
+    '-T2_XX_S5'])
+
+def getaddrinfo (host, port, *args):
+
+    if fl.is_a_valid_ip(host):
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (host, port))]
+    if host not in dns:
+        raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+
+    return [ (socket.AF_INET, socket.SOCK_STREAM, 6, '', (ip, port)) for ip in dns[host] ]
+
+def getfqdn (name=''):
+
+    parts = name.split('.')
+    if len(parts) == 4 and parts[0] == '10':
+        return 'host-{0}.s{1}.org'.format(name.replace('.', '-'), parts[1])
+    return name
+
+class FakeGeoIP(object):
+
+    def org_by_addr (self, address):
+
+        return 'Inst' + address.split('.')[1]
+
+    def org_by_name (self, host):
+
+        return self.org_by_addr(fl.get_host_ipv4_addr(host))
+
+    def org_by_addrs (self, addresses):
+
+        return pd.Series(addresses).map(self.org_by_addr)
+
+def old_gen_geo_entries (squid_hostname, institution, site):
+
+    host_data = squid_hostname.split(':')
+    if len(host_data) == 1:
+        listed_host_name = host_data[0]
+        protocol = port = ''
+    else:
+        protocol, listed_host_name, port = host_data
+
+    ip_addresses = fl.simple_get_hosts_ipv4_addrs(listed_host_name)
+    is_dns = (len(ip_addresses) > 1)
+
+    entries = []
+    for ip in ip_addresses:
+
+        if ip == '0.0.0.0':
+            host_name = listed_host_name
+        else:
+            host_name = socket.getfqdn(ip)
+
+        entries.append({'Institution': institution,
+                        'Site': site,
+                        'Host': host_name,
+                        'Alias': listed_host_name,
+                        'Ip': ip,
+                        'Port': port,
+                        'IsDNS': is_dns})
+    return entries
+
+def old_expand_geolist (geo_list):
+
+    squids = []
+    for line in geo_list.split('Directory'):
+        e = line.split()
+        if len(e) != 6:
+            continue
+        proxies = set( e[4].strip(';DIRECT').replace(';','|').split('|') )
+        for proxy in proxies:
+            squids.extend( old_gen_geo_entries(proxy.replace('/',''), e[0].strip('/<>'), e[2]) )
+
+    return pd.DataFrame(squids)
+
+def old_patch_geo_table (geo, MO_view, WN_view, actions, geoip):
+
+    geo_new = geo[~geo.IsDNS].copy()
+
+    MO_to_add = MO_view[~(MO_view.Host.isin(geo_new.Alias) | MO_view.Host.isin(geo_new.Host))].copy()
+    MO_to_add['Institution'] = MO_to_add.Host.apply(geoip.org_by_name)
+    MO_to_add = pd.DataFrame(fl.flatten(old_gen_geo_entries(r['Host'], r['Institution'], r['Site'])
+                                        for r in MO_to_add.to_dict('records')))
+    geo_new = pd.concat([geo_new, MO_to_add], ignore_index=True)
+
+    geo_new = geo_new[ ~geo_new.Site.isin(actions[actions == '-'].index) ]
+
+    for idx, elem in WN_view[ WN_view.Site.isin(geo_new.Site) ].iterrows():
+        sel = ((geo_new.Alias == elem.Host) | (geo_new.Host == elem.Host)) & (geo_new.Site == elem.Site)
+        geo_new = geo_new[~sel]
+
+    return geo_new
+
+def canonical (table):
+
+    columns = sorted(table.columns)
+    return table[columns].sort_values(columns).reset_index(drop=True)
+
+class GeoTableTest(unittest.TestCase):
+
+    def setUp (self):
+
+        self.socket_functions = socket.getaddrinfo, socket.getfqdn
+        socket.getaddrinfo, socket.getfqdn = getaddrinfo, getfqdn
+        self.geoip = FakeGeoIP()
+
+    def tearDown (self):
+
+        socket.getaddrinfo, socket.getfqdn = self.socket_functions
+
+    def test_expansion (self):
+
+        geo = fl.parse_geolist(geo_list, fl.HostResolver(workers=4))
+        reference = old_expand_geolist(geo_list)
+
+        self.assertEqual(len(geo), 12)
+        self.assertTrue(canonical(geo).equals(canonical(reference)))
+
+    def test_patch (self):
+
+        geo = old_expand_geolist(geo_list)
+        actions, WN_view, MO_view = fl.parse_exceptionlist(exception_list)
+
+        patched = fl.patch_geo_table(geo, MO_view, WN_view, actions, self.geoip,
+                                     fl.HostResolver(workers=4))
+        reference = old_patch_geo_table(geo, MO_view, WN_view, actions, self.geoip)
+
+        self.assertTrue(canonical(patched).equals(canonical(reference)))
+        # What each step should have done
+        self.assertFalse(patched.IsDNS.any())
+        self.assertNotIn('T2_XX_S5', set(patched.Site))
+        self.assertNotIn('sq0.s1.org', set(patched.Alias))
+        self.assertNotIn('sq1.s2.org', set(patched.Alias))
+        self.assertEqual(set(patched.Alias) & set(['sq2.s1.org', 'mon.s2.org', 'mon.s6.org']),
+                         set(['sq2.s1.org', 'mon.s2.org', 'mon.s6.org']))
+        self.assertEqual((patched.Alias == 'sq0.s2.org').sum(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
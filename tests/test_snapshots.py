@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+
+# The counters of the previous snapshot are found by host name, whatever
+# address the host resolved to when it was taken.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import FailoverLib as fl
+
+last = pd.DataFrame({'Host': ['wn0.s1.org', 'wn1.s1.org', 'wn0.s2.org'],
+                     # The first one did not resolve then
+                     'Ip': ['0.0.0.0', '10.1.0.1', '10.2.0.0'],
+                     'Hits': [1000000, 5, 7], 'Bandwidth': [10, 5, 7]})
+
+now = pd.DataFrame({'Host': ['wn0.s1.org', 'wn1.s1.org', 'wn9.s1.org', 'wn0.s2.org'],
+                    'Ip': ['10.1.0.0', '10.1.0.1', '10.1.0.9', '10.2.0.5'],
+                    'Hits': [1000010, 6, 3, 7], 'Bandwidth': [11, 6, 3, 7]})
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp (self):
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown (self):
+
+        shutil.rmtree(self.directory)
+
+    def test_changed_address (self):
+
+        store = fl.SnapshotStore(self.directory)
+        store.save('group', last, 1000)
+        timestamp, snapshot = store.load('group')
+
+        counters = fl.snapshot_counters(snapshot, now)
+
+        self.assertEqual(timestamp, 1000)
+        self.assertEqual(list(counters['Hits']), [1000000, 5, 0, 7])
+        self.assertEqual(list(counters['Bandwidth']), [10, 5, 0, 7])
+
+    def test_address_sorted_snapshot (self):
+
+        # As saved before snapshots were keyed by host name
+        snapshot = fl.host_snapshot(last)
+        snapshot.sort(order=['Ip', 'Host'])
+
+        counters = fl.snapshot_counters(snapshot, now)
+
+        self.assertEqual(list(counters['Hits']), [1000000, 5, 0, 7])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+#! /usr/bin/env python
+
+# Evaluates a sweep of rate thresholds for each server group over the
+# recorded failover history: how many sites each threshold flags, and how
+# many alarm emails would have been sent, without re-running the monitor.
+#
+# The records only hold sites that were over the threshold in use when they
+# were made, so thresholds below it are judged against an incomplete history
+# (a replay with a low threshold gives a complete one).
+
+import argparse
+import imp
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import FailoverLib as fl
+
+my_path = os.path.dirname(os.path.abspath(__file__))
+hm = imp.load_source('hourly_monitor', os.path.join(my_path, 'hourly-monitor.py'))
+
+def main():
+
+    args = parse_arguments()
+
+    config = json.load( open(os.path.expanduser(args.config_file)))
+
+    if args.records:
+        records = pd.read_csv(os.path.expanduser(args.records), index_col=False)
+    else:
+        records = load_history(config)
+    if records is None or not len(records):
+        sys.stderr.write("There is no failover history to evaluate.\n")
+        return 1
+
+    # Plain columns, as categoricals would group into every combination
+    records = fl.expand_host_table(records)
+    runs = np.unique(records['Timestamp'].values)
+    periodicity = config['emails']['periodicity'] * 3600
+    period = config['history']['period'] * 60
+    sweeps = []
+
+    for group_name, groupconf in sorted(config['groups'].items()):
+        configured = groupconf['rate_threshold']
+        thresholds = args.thresholds
+        if thresholds is None:
+            thresholds = configured * np.arange(0.25, 4.01, 0.25)
+
+        totals = site_totals(records[ records['Group'] == group_name ])
+        sweep = sweep_thresholds(totals, np.asarray(thresholds, dtype=float), runs,
+                                 periodicity, period)
+        sweep.insert(0, 'Group', group_name)
+        sweep['Configured'] = np.isclose(sweep['Threshold'], configured)
+        sweeps.append(sweep)
+
+    result = pd.concat(sweeps, ignore_index=True)
+
+    if args.output:
+        result.to_csv(args.output, index=False, float_format="%.2f")
+    print result.to_string(index=False, float_format=lambda x: '%.2f' % x)
+
+    return 0
+
+def parse_arguments ():
+
+    parser = argparse.ArgumentParser(description="Evaluates candidate rate thresholds "
+                                                 "over the recorded failover history.")
+    parser.add_argument('config_file')
+    parser.add_argument('--records',
+                        help="Failover record CSV to use instead of the configured history "
+                             "(e.g. the output of a replay)")
+    parser.add_argument('--thresholds', type=parse_thresholds,
+                        help="Comma separated thresholds, or start:stop:step "
+                             "(default: 0.25 to 4 times each group's threshold)")
+    parser.add_argument('--output', help="Also write the results to this CSV file")
+
+    return parser.parse_args()
+
+def parse_thresholds (text):
+
+    try:
+        if ':' in text:
+            start, stop, step = [ float(n) for n in text.split(':') ]
+            return np.arange(start, stop + step / 2.0, step)
+        return [ float(n) for n in text.split(',') ]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid thresholds: {0}".format(text))
+
+def load_history (config):
+
+    store = hm.open_record_store(config)
+    if store is not None and not store.is_empty():
+        return store.read()
+
+    record_file = os.path.expanduser(config['record_file'])
+    if os.path.exists(record_file):
+        return pd.read_csv(record_file, index_col=False)
+
+    return None
+
+def site_totals (records):
+
+    # What excess_failover_check compares against the threshold
+    non_squids = records[ ~records['IsSquid'].astype(bool) ]
+    totals = non_squids.groupby(['Sites', 'Timestamp'])['HitsRate'].sum()
+
+    return totals.dropna().reset_index()
+
+def sweep_thresholds (totals, thresholds, runs, periodicity, period):
+
+    count = len(thresholds)
+    sweep = pd.DataFrame({'Threshold': thresholds,
+                          'Intervals': np.zeros(count, dtype=int),
+                          'Sites': np.zeros(count, dtype=int),
+                          'Emails': np.zeros(count, dtype=int)},
+                         columns=['Threshold', 'Intervals', 'Sites', 'Emails'])
+    if not len(totals):
+        return sweep
+
+    rates = totals['HitsRate'].values
+    # A site is flagged on an interval when its total is over the threshold
+    sorted_rates = np.sort(rates)
+    sweep['Intervals'] = len(rates) - np.searchsorted(sorted_rates, thresholds, side='right')
+    peaks = np.sort(totals.groupby('Sites')['HitsRate'].max().values)
+    sweep['Sites'] = len(peaks) - np.searchsorted(peaks, thresholds, side='right')
+
+    sweep['Emails'] = count_emails(totals, thresholds, runs, periodicity, period)
+
+    return sweep
+
+def persistent_pairs (totals, period):
+
+    # The pairs of records of a site that mark_activity_for_mail would find
+    # consecutive and without wait, for the thresholds in [low, high): those
+    # over the totals of any record between them and below both of theirs.
+    site_codes, _ = pd.factorize(totals['Sites'])
+    order = np.lexsort((totals['Timestamp'].values, site_codes))
+    sites = site_codes[order]
+    times = totals['Timestamp'].values[order]
+    rates = totals['HitsRate'].values[order]
+
+    pairs = []
+    between = np.full(len(rates), -np.inf)
+    for offset in range(1, len(rates)):
+        first, second = np.arange(len(rates) - offset), np.arange(offset, len(rates))
+        same_site = sites[first] == sites[second]
+        waits = fl.wait_periods(times[second] - times[first], period)
+        # Gaps only grow with the offset, and so do waits
+        if not (same_site & (waits <= 0)).any():
+            break
+
+        if offset > 1:
+            between = np.maximum(between[:len(first)], rates[second - 1])
+        else:
+            between = between[:len(first)]
+
+        found = same_site & (waits == 0)
+        pairs.append(pd.DataFrame({'Site': sites[first][found],
+                                   'Start': times[first][found],
+                                   'End': times[second][found],
+                                   'Low': between[found],
+                                   'High': np.minimum(rates[first], rates[second])[found]}))
+
+    if not pairs:
+        return None
+
+    return pd.concat(pairs, ignore_index=True).sort_values('End')
+
+def count_emails (totals, thresholds, runs, periodicity, period):
+
+    pairs = persistent_pairs(totals, period)
+    if pairs is None:
+        return np.zeros(len(thresholds), dtype=int)
+
+    sites = pairs['Site'].values
+    starts = pairs['Start'].values
+    ends = pairs['End'].values
+    valid = ( (pairs['Low'].values[:, np.newaxis] <= thresholds) &
+              (thresholds < pairs['High'].values[:, np.newaxis]) )
+
+    # Per site and threshold: start of the latest persistent pair, and last email
+    latest_start = np.full((sites.max() + 1, len(thresholds)), -np.inf)
+    last_email = np.full((sites.max() + 1, len(thresholds)), -np.inf)
+    emails = np.zeros(len(thresholds), dtype=int)
+    next_pair = 0
+
+    # Each run marks the sites with a persistent pair inside its email window,
+    # unless they were notified within that window already
+    for now_timestamp in runs:
+        while next_pair < len(ends) and ends[next_pair] <= now_timestamp:
+            site = sites[next_pair]
+            found = np.where(valid[next_pair], starts[next_pair], -np.inf)
+            latest_start[site] = np.maximum(latest_start[site], found)
+            next_pair += 1
+
+        start_of_window = now_timestamp - periodicity
+        sent = (latest_start >= start_of_window) & (last_email < start_of_window)
+        last_email[sent] = now_timestamp
+        emails += sent.sum(axis=0)
+
+    return emails
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,6 +14,7 @@ var Failover = new function() {
     self.squid_chart = dc.pieChart("#squid-chart");
     self.hosts_table = dc.dataTable("#hosts-table");
     self.date_format = d3.time.format("%b %d, %Y %I:%M %p");
+    self.day_format = d3.time.format("%Y-%m-%d");
     self.sites_legend_item_size = 17;
     self.sites_legend_item_gap = 4;
     self.time_chart_width = 1024;
@@ -22,13 +23,15 @@ var Failover = new function() {
     self.groups_legend_width = 200;
     self.groups_radius = self.groups_base_dim/2 - 15;
     self.time_zone_offset = 0;
+    self.drilled = false;
 
     self.start = function() {
         d3.json(self.config_file, 
                 function (error, config) {
                     self.create_objects(config);
-                    queue().defer(d3.csv, self.config["record_file"])
-                           .defer(d3.csv, self.config["emails"]["record_file"])
+                    self.window = self.url_window();
+                    queue().defer(d3.csv, self.records_file())
+                           .defer(d3.csv, self.emails_file())
                            .await(self.first_setup);
                 });
     };
@@ -78,18 +81,20 @@ var Failover = new function() {
 
         // Site filtering actions
         self.site_filter = function (name) {
-                               var short_n = name.split('\n')[0]
-                                             + (name.contains('\n') ? ', ...' : '');
-                               self.site_D.filterExact(name);
-                               self.time_chart.turnOnControls();
-                               dc.redrawAll();
-                               // This must be run after redrawAll, else it does not render
-                               self.time_chart.select('.filter')
-                                              .text(short_n)
-                                              .property('title', name);
-
-                               // Blind update of URL query string
-                               history.pushState(null, '', '?site=' + encodeURIComponent(name));
+                               self.drill_down( function() {
+                                   var short_n = name.split('\n')[0]
+                                                 + (name.contains('\n') ? ', ...' : '');
+                                   self.site_D.filterExact(name);
+                                   self.time_chart.turnOnControls();
+                                   dc.redrawAll();
+                                   // This must be run after redrawAll, else it does not render
+                                   self.time_chart.select('.filter')
+                                                  .text(short_n)
+                                                  .property('title', name);
+
+                                   // Blind update of URL query string
+                                   history.pushState(null, '', self.page_query({site: name}));
+                               });
         }
 
         // Set color distribution for color consistency among page visits
@@ -348,9 +353,10 @@ var Failover = new function() {
             row.IsSquid = (d.IsSquid == "True");
             row.Sites = d.Sites.replace(/; /g, '\n');
 
-            row.Host = d.Host;
-            row.Ip = d.Ip;
-            row.Alias = d.Alias;
+            // Rollup rows stand for all the hosts of a site in a period
+            row.Host = ( d.Host === undefined ? d.Hosts + ' hosts' : d.Host );
+            row.Ip = ( d.Ip === undefined ? '' : d.Ip );
+            row.Alias = ( d.Alias === undefined ? '' : d.Alias );
             row.Group = d.Group;
 
             processed.push(row);
@@ -381,9 +387,120 @@ var Failover = new function() {
         return processed;
     };
 
+    self.query_server = function() {
+        var server = self.config.query_server;
+        return ( server && server.url ) ? server.url : null;
+    };
+
+    self.records_file = function() {
+        var server = self.query_server();
+
+        // Compact rollups are shown until someone drills down
+        if (server)
+            return server + '/records?' + self.window_query({
+                            view: ( self.drilled ? 'raw' : 'aggregated' ),
+                            bucket: self.period });
+        if (self.config.rollups && !self.drilled)
+            return variant_file(self.config["record_file"], 'rollup');
+        return self.config["record_file"];
+    };
+
+    self.emails_file = function() {
+        var server = self.query_server();
+
+        if (server)
+            return server + '/emails?' + self.window_query({});
+        return self.config["emails"]["record_file"];
+    };
+
+    // The time window on display: the URL's start and end (in seconds
+    //  since the epoch) when given, else the last record span
+    self.url_window = function() {
+        var url_params = getUrlVars();
+
+        if ("start" in url_params && "end" in url_params)
+            return [new Date(1e3 * url_params["start"]),
+                    new Date(1e3 * url_params["end"])];
+        return null;
+    };
+
+    self.time_window = function() {
+        if (self.window)
+            return self.window;
+
+        var end = new Date();
+        return [new Date(end.getTime() - self.extent_span), end];
+    };
+
+    self.window_query = function(params) {
+        var span = self.time_window(),
+            args = ['start=' + Math.floor(span[0].getTime() / 1e3),
+                    'end=' + Math.floor(span[1].getTime() / 1e3)];
+
+        for (var name in params)
+            args.push(name + '=' + encodeURIComponent(params[name]));
+        return args.join('&');
+    };
+
+    self.page_query = function(params) {
+        var args = [];
+
+        if (self.window) {
+            args.push('start=' + Math.floor(self.window[0].getTime() / 1e3));
+            args.push('end=' + Math.floor(self.window[1].getTime() / 1e3));
+        }
+        for (var name in params)
+            args.push(name + '=' + encodeURIComponent(params[name]));
+        return '?' + args.join('&');
+    };
+
+    self.select_window = function(start, end) {
+        self.window = [start, end];
+        history.pushState(null, '', self.page_query({}));
+        self.reload();
+    };
+
+    // The window picked with the date inputs, from the start of its
+    //  first day to the end of its last one
+    self.select_dates = function() {
+        var start = self.day_format.parse(d3.select("#window-start").property("value")),
+            end = self.day_format.parse(d3.select("#window-end").property("value"));
+
+        if (!start || !end || end < start)
+            return;
+        self.select_window(start, d3.time.day.offset(end, 1));
+    };
+
+    self.drill_down = function(callback) {
+
+        if (!(self.config.rollups || self.query_server()) || self.drilled) {
+            callback();
+            return;
+        }
+
+        self.drilled = true;
+        d3.csv(self.records_file(), function (error, dataset) {
+            // Records are only removed from crossfilter if they match
+            //  the current filters, so these are lifted and then restored
+            var charts = [self.group_chart, self.squid_chart],
+                kept = charts.map(function(c) { return c.filters().slice(); });
+
+            dc.filterAll();
+            self.site_D.filterAll();
+            self.host_D.filterAll();
+            self.ndx.remove();
+            self.setup_update(dataset, self.emails_rec);
+            charts.forEach(function(c, i) {
+                kept[i].forEach(function(f) { c.filter(f); });
+            });
+            dc.renderAll();
+            callback();
+        });
+    };
+
     self.reload = function() {
-        queue().defer(d3.csv, self.config["record_file"])
-               .defer(d3.csv, self.config["emails"]["record_file"])
+        queue().defer(d3.csv, self.records_file())
+               .defer(d3.csv, self.emails_file())
                .await(function (error, dataset, emails) {
                     self.ndx.remove();
                     self.setup_update(dataset, emails);
@@ -399,10 +516,14 @@ var Failover = new function() {
 
     self.update_time_extent = function(period, extent_span) {
 
+        // A selected window takes precedence over the default span
+        if (self.window)
+            extent_span = self.window[1] - self.window[0];
+
         var periodObj = minuteBunch(period),
             periodRange = periodObj.range,
             hour = 3.6e6,
-            now = new Date(),
+            now = self.time_window()[1],
             this_hour = periodObj(now).getTime() + self.time_zone_offset,
             extent = [new Date(this_hour - extent_span),
                       new Date(this_hour)],
@@ -416,6 +537,8 @@ var Failover = new function() {
         d3.select("#date-end")
           .attr("datetime", extent[1])
           .text(self.date_format(extent[1]));
+        d3.select("#window-start").property("value", self.day_format(extent[0]));
+        d3.select("#window-end").property("value", self.day_format(extent[1]));
 
         self.extent = extent_pad;
     };
@@ -425,7 +548,7 @@ var Failover = new function() {
         self.time_chart.turnOffControls();
         dc.redrawAll();
        // Blind update of URL query string
-       history.pushState(null, '', '?');
+       history.pushState(null, '', self.page_query({}));
     };
 
     self.hosts_table_reset = function() {
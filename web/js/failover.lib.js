@@ -43,6 +43,18 @@ function flatten_array (arr)
     return flat;
 }
 
+/* 
+  Inserts a variant tag before the extension of a file
+  name, e.g. "record.csv" -> "record.rollup.csv", matching
+  the names given by the monitor to its derived files.
+*/
+function variant_file (file_path, variant)
+{
+    var parts = file_path.split('.');
+    parts.splice(parts.length - 1, 0, variant);
+    return parts.join('.');
+}
+
 /* 
   Generates a set of CSS color specifications
   based on the HSL model, by uniformly dividing